@@ -1,13 +1,27 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, Request, render_template, request, jsonify, redirect, url_for, flash, session, make_response, g, has_app_context
 from markupsafe import Markup, escape
 from dotenv import load_dotenv
 import os
 import secrets
+import threading
+import time
+from functools import wraps
+from contextlib import contextmanager
+import hashlib
+import json
+import csv
+import re
+import unicodedata
+import mmap
+import struct
 import pymysql
-from datetime import datetime
-from PIL import Image
+from datetime import datetime, timedelta
+from decimal import Decimal
+from bisect import bisect_right
+from PIL import Image, ImageOps
 import folium
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 import base64
 from io import BytesIO
 import matplotlib
@@ -17,8 +31,9 @@ import boto3
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError
 
 load_dotenv()
+# As rotas são registradas neste objeto; create_app() (no fim do arquivo) aplica a configuração
+# e o estado por processo. Vercel e gunicorn importam `app` deste módulo.
 app = Flask(__name__)
-app.secret_key = secrets.token_urlsafe(16)
 
 # Credenciais e Configurações AWS S3
 S3_BUCKET = os.getenv('S3_BUCKET_NAME')
@@ -27,34 +42,85 @@ S3_SECRET_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 S3_REGION = os.getenv('AWS_REGION')
 
 s3_client = None
-if S3_BUCKET and S3_ACCESS_KEY and S3_SECRET_KEY and S3_REGION:
-    try:
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=S3_ACCESS_KEY,
-            aws_secret_access_key=S3_SECRET_KEY,
-            region_name=S3_REGION
-        )
-        app.logger.info(f"Cliente S3 inicializado para o bucket {S3_BUCKET} na região {S3_REGION}")
-    except Exception as e:
-        app.logger.error(f"Erro ao inicializar cliente S3: {e}")
-else:
-    app.logger.warning("Credenciais S3 ou nome do bucket não configurados. Uploads para S3 estarão desabilitados.")
+
+
+def init_s3():
+    """Cria o cliente S3 deste processo (clientes boto3 não devem atravessar um fork)."""
+    global s3_client
+    s3_client = None
+    if S3_BUCKET and S3_ACCESS_KEY and S3_SECRET_KEY and S3_REGION:
+        try:
+            s3_client = boto3.client(
+                's3',
+                aws_access_key_id=S3_ACCESS_KEY,
+                aws_secret_access_key=S3_SECRET_KEY,
+                region_name=S3_REGION
+            )
+            app.logger.info(f"Cliente S3 inicializado para o bucket {S3_BUCKET} na região {S3_REGION} (pid {os.getpid()})")
+        except Exception as e:
+            app.logger.error(f"Erro ao inicializar cliente S3: {e}")
+    else:
+        app.logger.warning("Credenciais S3 ou nome do bucket não configurados. Uploads para S3 estarão desabilitados.")
+    return s3_client
 
 
 # Configurações de Upload
-TMP_UPLOAD_DIR = '/tmp/buscapet_uploads' # Diretório temporário na Vercel
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 THUMBNAIL_SIZE = (100, 100) # Tamanho do thumbnail
-
-
-# Função para criar diretório temporário se não existir
-def ensure_tmp_upload_dir():
-    original_tmp = os.path.join(TMP_UPLOAD_DIR, 'imagens_pet')
-    thumbnail_tmp = os.path.join(TMP_UPLOAD_DIR, 'thumbnails_pet')
-    os.makedirs(original_tmp, exist_ok=True)
-    os.makedirs(thumbnail_tmp, exist_ok=True)
-    return original_tmp, thumbnail_tmp
+# Fotos acima disso são recusadas só pelo cabeçalho, antes de decodificar (48 MP de celular passam)
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 50_000_000))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS # Também protege os demais Image.open (atlas, thumbnails do S3)
+# Uploads ficam em memória (ver RequisicaoUploadEmMemoria); acima disso a requisição é recusada com 413
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 25 * 1024 * 1024))
+
+# Sprite atlas dos ícones do mapa: todos os thumbnails dos casos abertos em uma única imagem no S3
+SPRITE_PREFIX = 'uploads/sprites/'
+SPRITE_CELL_SIZE = 96 # Pixels por célula (2x o tamanho exibido, para telas de alta densidade)
+SPRITE_COLUMNS = 32
+MARKER_IMG_SIZE = 48 # Tamanho exibido da foto dentro do ícone do marcador
+SPRITE_MANIFEST_TTL_SECONDS = 60 # Cache em memória do manifesto para a rota principal
+SPRITE_LOCK_TIMEOUT_SECONDS = 10 # Espera máxima pela trava do atlas (GET_LOCK do MySQL)
+
+# Renderizador do mapa: 'leve' (template Leaflet com marcadores em JSON) ou 'folium' (objetos por marcador)
+MAP_RENDERER = os.getenv('MAP_RENDERER', 'leve')
+
+# Cidades atendidas. A tabela CIDADES (ver others/documentation_app.txt) complementa/sobrescreve
+# este registro embutido; CIDADE_PADRAO é usada quando nenhuma cidade é informada.
+CIDADE_PADRAO = os.getenv('CIDADE_PADRAO', 'Americana/SP')
+CIDADES_EMBUTIDAS = [
+    {'nome': 'Americana/SP', 'centro': [-22.7532, -47.3330], 'zoom': 13,
+     'limites': [[-22.80, -47.40], [-22.66, -47.20]]},
+]
+CIDADES_CACHE_TTL_SECONDS = 600
+CIDADES_FALHA_TTL_SECONDS = 30 # Com o banco indisponível, o registro só com as embutidas é cacheado por pouco tempo
+LOCALIDADES_CACHE_TTL_SECONDS = 3600 # Bairros/ruas de LOCATIONS mudam raramente
+GAZETTEER_VERIFICACAO_FALHA_TTL_SECONDS = 30 # Banco indisponível: espera antes de tentar verificar o snapshot de novo
+
+# Snapshot binário de LOCATIONS (gerado por others/build_gazetteer_snapshot.py) aberto via mmap
+GAZETTEER_SNAPSHOT_PATH = os.getenv('GAZETTEER_SNAPSHOT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gazetteer.bin'))
+
+# Idempotência e controle de admissão das rotas de escrita (estado em memória, por processo)
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 600)) # Janela de deduplicação dos envios
+IDEMPOTENCY_WAIT_SECONDS = 30 # Quanto uma duplicata espera o envio original terminar
+IDEMPOTENCY_MAX_ENTRIES = 2000
+RATE_LIMIT_MAX_BUCKETS = 10000
+# Número de proxies confiáveis na frente do app que acrescentam ao X-Forwarded-For. Só com eles o
+# cabeçalho é usado para identificar o cliente; sem proxy (ex: gunicorn exposto direto) ele é forjável.
+# Na Vercel (variável VERCEL definida) a borda sobrescreve o cabeçalho com o IP real: 1 por padrão.
+PROXY_FIX_X_FOR = int(os.getenv('PROXY_FIX_X_FOR', '1' if os.getenv('VERCEL') else '0'))
+if PROXY_FIX_X_FOR:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_X_FOR)
+
+# Limites superiores (em horas) das faixas do histograma de tempo até a resolução.
+# A última faixa (índice len(...)) é aberta: tudo acima de 90 dias.
+FAIXAS_TEMPO_RESOLUCAO_HORAS = [1, 3, 6, 12, 24, 48, 72, 168, 336, 720, 2160]
+
+# Índice de termos dos comentários (nuvem de palavras): termos mais curtos que isso são ignorados
+TERMO_MIN_CARACTERES = 3
+TERMO_MAX_CARACTERES = 60 # Tamanho da coluna TERMO
+
+# Exportação de casos (CSV/GeoJSON): linhas lidas do cursor do servidor em lotes deste tamanho
+EXPORT_LOTE_LINHAS = 500
 
 
 # Registrar filtro nl2br customizado
@@ -98,21 +164,114 @@ def open_conn():
         return None
 
 
-def create_thumbnail(image_path, thumbnail_path, size=THUMBNAIL_SIZE):
+# --- Unidade de trabalho por requisição ---
+# Cada requisição usa no máximo uma conexão, aberta só no primeiro uso e guardada em flask.g.
+# Escritas rodam dentro de transacao(), que confirma ao final do bloco (antes dos efeitos colaterais
+# como S3 e sprite atlas); o que sobrar é confirmado no teardown, ou desfeito se a requisição falhou.
+_SEM_CONEXAO = object() # Marca a falha de conexão para não tentar de novo (connect_timeout) na mesma requisição
+
+
+def conexao_requisicao():
+    """Conexão da requisição atual, aberta no primeiro uso. None se o banco estiver indisponível."""
+    conn = g.get('_db_conn')
+    if conn is None:
+        conn = open_conn()
+        g._db_conn = conn or _SEM_CONEXAO
+    return None if conn is _SEM_CONEXAO else conn
+
+
+@contextmanager
+def transacao(conn):
+    """Cursor transacional: commit ao final do bloco, rollback (e a exceção segue adiante) em caso de erro."""
     try:
-        with Image.open(image_path) as img: # Usar 'with' para garantir fechamento do arquivo
-            img.thumbnail(size)
-            img.save(thumbnail_path)
-        return True
+        with conn.cursor() as cursor:
+            yield cursor
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+@contextmanager
+def conexao_compartilhada():
+    """Dentro de uma requisição reutiliza a conexão dela; fora (scripts em others/) abre e fecha uma própria."""
+    if has_app_context():
+        yield conexao_requisicao()
+        return
+    conn = open_conn()
+    try:
+        yield conn
+    finally:
+        if conn:
+            conn.close()
+
+
+@app.teardown_appcontext
+def encerrar_conexao_requisicao(exc):
+    conn = g.pop('_db_conn', None)
+    if conn is None or conn is _SEM_CONEXAO:
+        return
+    try:
+        if exc is None:
+            conn.commit()
+        else:
+            conn.rollback()
+    except pymysql.MySQLError as e:
+        app.logger.error(f"Erro ao finalizar a transação da requisição: {e}")
+    finally:
+        conn.close()
+
+
+class RequisicaoUploadEmMemoria(Request):
+    """Mantém os arquivos enviados em memória.
+
+    O padrão do Werkzeug grava em um arquivo temporário (em /tmp) todo upload acima de 500 KB, ou seja,
+    qualquer foto de celular. O tamanho total é limitado por MAX_CONTENT_LENGTH (MAX_UPLOAD_BYTES).
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return BytesIO()
+
+
+app.request_class = RequisicaoUploadEmMemoria
+
+
+def create_thumbnail(origem, size=THUMBNAIL_SIZE):
+    """Gera o thumbnail (bytes) a partir de um caminho ou arquivo aberto, sem passar pelo disco.
+
+    JPEG e MPO (o JPEG com várias imagens de muitos celulares) viram JPEG; os demais formatos são mantidos.
+    Só o cabeçalho é lido antes da checagem de MAX_IMAGE_PIXELS. Em JPEG/MPO, draft() faz o decodificador
+    trabalhar direto na escala 1/2, 1/4 ou 1/8 mais próxima do tamanho final, e só então a orientação
+    EXIF é aplicada (exif_transpose carrega a imagem, então precisa vir depois do draft).
+    Retorna None se a imagem for inválida ou grande demais.
+    """
+    try:
+        with Image.open(origem) as img: # Usar 'with' para garantir fechamento do arquivo
+            largura, altura = img.size
+            if largura * altura > MAX_IMAGE_PIXELS:
+                app.logger.warning(f"Imagem recusada: {largura}x{altura} acima do limite de {MAX_IMAGE_PIXELS} pixels.")
+                return None
+            formato = 'JPEG' if img.format in ('JPEG', 'MPO') else img.format
+            if formato == 'JPEG':
+                img.draft('RGB', size)
+            thumb = ImageOps.exif_transpose(img)
+            thumb.thumbnail(size, reducing_gap=2.0) # PNG não tem draft: reduce() por blocos antes do filtro final
+            if formato == 'JPEG' and thumb.mode not in ('RGB', 'L'):
+                thumb = thumb.convert('RGB')
+            buffer = BytesIO()
+            thumb.save(buffer, format=formato)
+        return buffer.getvalue()
     except FileNotFoundError:
-        app.logger.error(f"Arquivo de imagem não encontrado em create_thumbnail: {image_path}")
+        app.logger.error(f"Arquivo de imagem não encontrado em create_thumbnail: {origem}")
+    except Image.DecompressionBombError as e:
+        app.logger.warning(f"Imagem recusada como bomba de descompressão: {e}")
     except Exception as e:
-        app.logger.error(f"Erro ao criar thumbnail para {image_path}: {e}")
-    return False
+        app.logger.error(f"Erro ao criar thumbnail: {e}")
+    return None
 
 
 def upload_to_s3(file_path, bucket_name, s3_file_key, content_type=None):
-    """Faz upload de um arquivo para um bucket S3 e o torna público."""
+    """Faz upload de um arquivo (caminho ou objeto com read(), como o stream do upload) para um bucket S3."""
     if not s3_client:
         app.logger.error("Cliente S3 não inicializado. Upload falhou.")
         return None
@@ -120,7 +279,11 @@ def upload_to_s3(file_path, bucket_name, s3_file_key, content_type=None):
         extra_args = {}
         if content_type:
             extra_args['ContentType'] = content_type
-        s3_client.upload_file(file_path, bucket_name, s3_file_key, ExtraArgs=extra_args)
+        if hasattr(file_path, 'read'):
+            file_path.seek(0)
+            s3_client.upload_fileobj(file_path, bucket_name, s3_file_key, ExtraArgs=extra_args)
+        else:
+            s3_client.upload_file(file_path, bucket_name, s3_file_key, ExtraArgs=extra_args)
         # URL do objeto no S3
         file_url = f"https://{bucket_name}.s3.{S3_REGION}.amazonaws.com/{s3_file_key}"
         app.logger.info(f"Upload bem-sucedido para S3: {file_url}")
@@ -161,123 +324,975 @@ def delete_from_s3(bucket_name, s3_file_key):
         app.logger.error(f"Erro inesperado durante a deleção do S3: {e}")
     return False
 
+
+def s3_public_url(s3_file_key):
+    if s3_file_key and S3_BUCKET and S3_REGION:
+        return f"https://{S3_BUCKET}.s3.{S3_REGION}.amazonaws.com/{s3_file_key}"
+    return '#'
+
+
+# --- Registro de cidades e caches de localidades por cidade ---
+_cidades_cache = {'dados': None, 'carregado_em': 0.0, 'ttl': CIDADES_CACHE_TTL_SECONDS}
+_localidades_lock = threading.Lock()
+_localidades_cache = {} # (cidade, bairro ou None) -> (expira_em, lista de bairros/ruas)
+
+
+def slug_cidade(nome):
+    """'Santa Bárbara d'Oeste/SP' -> 'santa-barbara-d-oeste-sp'."""
+    sem_acentos = unicodedata.normalize('NFKD', nome.strip()).encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'[^a-z0-9]+', '-', sem_acentos.lower()).strip('-')
+
+
+def _montar_cidade(nome, centro, zoom, limites):
+    return {'slug': slug_cidade(nome), 'nome': nome, 'centro': centro, 'zoom': zoom, 'limites': limites}
+
+
+def carregar_cidades():
+    """Retorna {slug: cidade} com o registro embutido mais as cidades ativas da tabela CIDADES (cache em memória)."""
+    agora = time.monotonic()
+    if _cidades_cache['dados'] and agora - _cidades_cache['carregado_em'] < _cidades_cache['ttl']:
+        return _cidades_cache['dados']
+    cidades = {}
+    for c in CIDADES_EMBUTIDAS:
+        cidade = _montar_cidade(c['nome'], c['centro'], c['zoom'], c['limites'])
+        cidades[cidade['slug']] = cidade
+    ttl = CIDADES_FALHA_TTL_SECONDS
+    with conexao_compartilhada() as conn:
+        if conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT NOME, LATITUDE, LONGITUDE, ZOOM, LAT_MIN, LON_MIN, LAT_MAX, LON_MAX
+                        FROM CIDADES WHERE ATIVA = 1
+                    """)
+                    for row in cursor.fetchall():
+                        limites = None
+                        if None not in (row['LAT_MIN'], row['LON_MIN'], row['LAT_MAX'], row['LON_MAX']):
+                            limites = [[float(row['LAT_MIN']), float(row['LON_MIN'])],
+                                       [float(row['LAT_MAX']), float(row['LON_MAX'])]]
+                        cidade = _montar_cidade(row['NOME'], [float(row['LATITUDE']), float(row['LONGITUDE'])],
+                                                row['ZOOM'] or 13, limites)
+                        cidades[cidade['slug']] = cidade
+                ttl = CIDADES_CACHE_TTL_SECONDS
+            except pymysql.MySQLError as e:
+                app.logger.warning(f"Registro de cidades indisponível no banco, usando apenas o embutido: {e}")
+    _cidades_cache.update(dados=cidades, carregado_em=agora, ttl=ttl)
+    return cidades
+
+
+def obter_cidade(identificador=None):
+    """Procura a cidade pelo slug ou pelo nome. Sem identificador, retorna a CIDADE_PADRAO; None se desconhecida."""
+    return carregar_cidades().get(slug_cidade(identificador or CIDADE_PADRAO))
+
+
+def cidade_nao_encontrada(endpoint, identificador):
+    """Resposta das páginas para cidade desconhecida: volta para a cidade padrão.
+
+    Se nem a CIDADE_PADRAO for encontrada (configuração errada, ou cidade só da tabela CIDADES com o
+    banco fora do ar), mostra uma página de erro em vez de redirecionar para a mesma rota em laço.
+    """
+    if identificador and obter_cidade():
+        flash("Cidade não encontrada.", "warning")
+        return redirect(url_for(endpoint))
+    app.logger.error(f"Cidade padrão '{CIDADE_PADRAO}' não encontrada no registro de cidades.")
+    return render_template('erro.html', titulo="Serviço indisponível",
+                           mensagem="Não foi possível carregar as cidades atendidas. Tente novamente em alguns instantes.",
+                           current_year=datetime.now().year), 503
+
+
+def _localidades_em_cache(chave, sql, params, coluna):
+    """Lista DISTINCT de LOCATIONS com cache por cidade. Retorna None se não houver conexão."""
+    agora = time.monotonic()
+    with _localidades_lock:
+        item = _localidades_cache.get(chave)
+    if item and item[0] > agora:
+        return item[1]
+    with conexao_compartilhada() as conn:
+        if not conn:
+            return None
+        with conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            valores = [row[coluna] for row in cursor.fetchall()]
+    with _localidades_lock:
+        _localidades_cache[chave] = (agora + LOCALIDADES_CACHE_TTL_SECONDS, valores)
+    return valores
+
+
+def listar_bairros(cidade_nome):
+    if gazetteer_atual():
+        bairros = _gazetteer.bairros(cidade_nome)
+        if bairros: # Cidade ausente do snapshot: consulta o banco
+            return bairros
+    verificar_gazetteer() # Já vai ao banco: aproveita para conferir se o snapshot está atual
+    return _localidades_em_cache((cidade_nome, None),
+                                 "SELECT DISTINCT BAIRRO FROM LOCATIONS WHERE CIDADE = %s ORDER BY BAIRRO ASC",
+                                 (cidade_nome,), 'BAIRRO')
+
+
+def listar_ruas(cidade_nome, bairro):
+    if gazetteer_atual():
+        ruas = _gazetteer.ruas(cidade_nome, bairro)
+        if ruas:
+            return ruas
+    verificar_gazetteer()
+    return _localidades_em_cache((cidade_nome, bairro),
+                                 "SELECT DISTINCT RUA FROM LOCATIONS WHERE CIDADE = %s AND BAIRRO = %s ORDER BY RUA ASC",
+                                 (cidade_nome, bairro), 'RUA')
+
+
+# --- Snapshot do gazetteer (LOCATIONS) em arquivo binário mapeado em memória ---
+# Layout (little-endian, seções de 4 bytes alinhadas logo após o cabeçalho):
+#   cabeçalho: magic 'BPGZ', versão, gerado_em (epoch), nº de strings, cidades, bairros e ruas,
+#              marcador de versão de LOCATIONS (nº de linhas lidas e maior ID; 0 = desconhecido)
+#   offsets das strings: u32[n_strings + 1] dentro do bloco de texto UTF-8 (strings internadas)
+#   cidades: (nome, primeiro bairro, qtd de bairros) u32 x3, ordenadas por chave_ordenacao
+#   bairros: (nome, primeira rua, qtd de ruas) u32 x3, ordenados dentro de cada cidade
+#   ruas: nome u32, seguidos de latitudes f32[n_ruas] e longitudes f32[n_ruas]
+#   bloco de texto UTF-8
+GAZETTEER_MAGIC = b'BPGZ'
+GAZETTEER_VERSAO = 2
+GAZETTEER_HEADER = struct.Struct('<4sIQIIIIII')
+
+
+def chave_ordenacao(texto):
+    """Ordem próxima à collation do MySQL (sem acentos e sem caixa), desempatando pelo texto original."""
+    sem_acentos = unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii')
+    return sem_acentos.casefold(), texto
+
+
+def escrever_snapshot_gazetteer(localizacoes, caminho, max_id=0):
+    """Gera o snapshot a partir de tuplas (cidade, bairro, rua, latitude, longitude).
+
+    Para ruas repetidas no mesmo bairro vale a primeira ocorrência, como no LIMIT 1 da consulta ao banco.
+    O nº de tuplas lidas e `max_id` (maior ID de LOCATIONS, 0 se desconhecido) formam o marcador
+    comparado por verificar_gazetteer() com a tabela.
+    """
+    arvore = {}
+    linhas = 0
+    for cidade, bairro, rua, lat, lon in localizacoes:
+        linhas += 1
+        arvore.setdefault(cidade, {}).setdefault(bairro, {}).setdefault(rua, (lat, lon))
+
+    strings, indice_strings = [], {}
+    def internar(texto):
+        if texto not in indice_strings:
+            indice_strings[texto] = len(strings)
+            strings.append(texto)
+        return indice_strings[texto]
+
+    cidades, bairros, ruas, lats, lons = [], [], [], [], []
+    for cidade in sorted(arvore, key=chave_ordenacao):
+        cidades.append((internar(cidade), len(bairros), len(arvore[cidade])))
+        for bairro in sorted(arvore[cidade], key=chave_ordenacao):
+            ruas_bairro = arvore[cidade][bairro]
+            bairros.append((internar(bairro), len(ruas), len(ruas_bairro)))
+            for rua in sorted(ruas_bairro, key=chave_ordenacao):
+                ruas.append(internar(rua))
+                lats.append(ruas_bairro[rua][0])
+                lons.append(ruas_bairro[rua][1])
+
+    blob = bytearray()
+    offsets = []
+    for texto in strings:
+        offsets.append(len(blob))
+        blob += texto.encode('utf-8')
+    offsets.append(len(blob))
+
+    temporario = f"{caminho}.tmp"
+    os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+    with open(temporario, 'wb') as f:
+        f.write(GAZETTEER_HEADER.pack(GAZETTEER_MAGIC, GAZETTEER_VERSAO, int(time.time()),
+                                      len(strings), len(cidades), len(bairros), len(ruas), linhas, max_id))
+        f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        f.write(struct.pack(f'<{len(cidades) * 3}I', *[v for c in cidades for v in c]))
+        f.write(struct.pack(f'<{len(bairros) * 3}I', *[v for b in bairros for v in b]))
+        f.write(struct.pack(f'<{len(ruas)}I', *ruas))
+        f.write(struct.pack(f'<{len(lats)}f', *lats))
+        f.write(struct.pack(f'<{len(lons)}f', *lons))
+        f.write(bytes(blob))
+    os.replace(temporario, caminho) # Troca atômica: processos com o arquivo antigo mapeado não são afetados
+    return len(cidades), len(bairros), len(ruas)
+
+
+class GazetteerSnapshot:
+    """Leitura do snapshot direto do mmap: nada é copiado para a memória do processo na abertura."""
+
+    def __init__(self, caminho):
+        with open(caminho, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, versao = struct.unpack_from('<4sI', self._mm, 0)
+        if magic != GAZETTEER_MAGIC or versao != GAZETTEER_VERSAO:
+            raise ValueError(f"Formato de snapshot não suportado: {magic!r} v{versao}")
+        (_, _, self.gerado_em, n_strings, n_cidades, n_bairros, n_ruas,
+         self.linhas_locations, self.max_id_locations) = GAZETTEER_HEADER.unpack_from(self._mm, 0)
+        visao = memoryview(self._mm)
+        posicao = GAZETTEER_HEADER.size
+        secoes = []
+        for quantidade, formato in ((n_strings + 1, 'I'), (n_cidades * 3, 'I'), (n_bairros * 3, 'I'),
+                                    (n_ruas, 'I'), (n_ruas, 'f'), (n_ruas, 'f')):
+            secoes.append(visao[posicao:posicao + 4 * quantidade].cast(formato))
+            posicao += 4 * quantidade
+        self._offsets, self._cidades, self._bairros, self._ruas, self._lats, self._lons = secoes
+        self._texto_bloco = visao[posicao:]
+
+    def _texto(self, indice):
+        return str(self._texto_bloco[self._offsets[indice]:self._offsets[indice + 1]], 'utf-8')
+
+    def _buscar(self, tabela, passo, inicio, quantidade, nome):
+        """Busca binária por nome em um intervalo ordenado por chave_ordenacao; retorna a posição ou None."""
+        alvo = chave_ordenacao(nome)
+        baixo, alto = inicio, inicio + quantidade
+        while baixo < alto:
+            meio = (baixo + alto) // 2
+            if chave_ordenacao(self._texto(tabela[meio * passo])) < alvo:
+                baixo = meio + 1
+            else:
+                alto = meio
+        if baixo < inicio + quantidade and self._texto(tabela[baixo * passo]) == nome:
+            return baixo
+        return None
+
+    def _faixa_bairros(self, cidade):
+        posicao = self._buscar(self._cidades, 3, 0, len(self._cidades) // 3, cidade)
+        if posicao is None:
+            return None
+        return self._cidades[posicao * 3 + 1], self._cidades[posicao * 3 + 2]
+
+    def _faixa_ruas(self, cidade, bairro):
+        faixa = self._faixa_bairros(cidade)
+        posicao = self._buscar(self._bairros, 3, faixa[0], faixa[1], bairro) if faixa and bairro else None
+        if posicao is None:
+            return None
+        return self._bairros[posicao * 3 + 1], self._bairros[posicao * 3 + 2]
+
+    def bairros(self, cidade):
+        faixa = self._faixa_bairros(cidade)
+        if not faixa:
+            return []
+        return [self._texto(self._bairros[i * 3]) for i in range(faixa[0], faixa[0] + faixa[1])]
+
+    def ruas(self, cidade, bairro):
+        faixa = self._faixa_ruas(cidade, bairro)
+        if not faixa:
+            return []
+        return [self._texto(self._ruas[i]) for i in range(faixa[0], faixa[0] + faixa[1])]
+
+    def coordenadas(self, cidade, bairro, rua):
+        faixa = self._faixa_ruas(cidade, bairro)
+        posicao = self._buscar(self._ruas, 1, faixa[0], faixa[1], rua) if faixa and rua else None
+        if posicao is None:
+            return None
+        # float32 -> 6 casas decimais (~0,1 m), a precisão útil do DECIMAL de LOCATIONS
+        return round(self._lats[posicao], 6), round(self._lons[posicao], 6)
+
+
+def abrir_gazetteer():
+    if not os.path.exists(GAZETTEER_SNAPSHOT_PATH):
+        app.logger.info("Snapshot do gazetteer não encontrado; bairros, ruas e coordenadas virão do banco.")
+        return None
+    try:
+        return GazetteerSnapshot(GAZETTEER_SNAPSHOT_PATH)
+    except (OSError, ValueError, struct.error) as e:
+        app.logger.error(f"Erro ao abrir o snapshot do gazetteer {GAZETTEER_SNAPSHOT_PATH}: {e}")
+        return None
+
+
+_gazetteer = abrir_gazetteer()
+
+
+# Resultado da última comparação do snapshot com LOCATIONS. O snapshot é confiado até uma
+# verificação dizer o contrário; ver verificar_gazetteer().
+_verificacao_gazetteer = {'confere': True, 'verificado_em': None, 'ttl': LOCALIDADES_CACHE_TTL_SECONDS}
+
+
+def _snapshot_confere(marcador):
+    linhas, max_id = marcador
+    # Snapshots gerados do CSV não conhecem os IDs: só o nº de linhas é comparado
+    return linhas == _gazetteer.linhas_locations and (not _gazetteer.max_id_locations or max_id == _gazetteer.max_id_locations)
+
+
+def verificar_gazetteer():
+    """Compara o marcador do snapshot com LOCATIONS (nº de linhas e maior ID).
+
+    Fora do caminho quente: roda no aquecimento dos caches e quando uma busca já vai ao banco
+    (bairro/rua/coordenada ausente do snapshot, ou snapshot desatualizado), no máximo uma vez por
+    LOCALIDADES_CACHE_TTL_SECONDS. Com o banco indisponível, o resultado anterior é mantido e a
+    próxima tentativa só acontece depois de GAZETTEER_VERIFICACAO_FALHA_TTL_SECONDS.
+    """
+    if not _gazetteer:
+        return
+    agora = time.monotonic()
+    verificado_em = _verificacao_gazetteer['verificado_em']
+    if verificado_em is not None and agora - verificado_em < _verificacao_gazetteer['ttl']:
+        return
+    row = None
+    try:
+        with conexao_compartilhada() as conn:
+            if conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT COUNT(*) AS total, COALESCE(MAX(ID), 0) AS max_id FROM LOCATIONS")
+                    row = cursor.fetchone()
+    except pymysql.MySQLError as e:
+        app.logger.warning(f"Não foi possível verificar a versão de LOCATIONS: {e}")
+    if row is None:
+        _verificacao_gazetteer.update(verificado_em=agora, ttl=GAZETTEER_VERIFICACAO_FALHA_TTL_SECONDS)
+        return
+    marcador = (row['total'], row['max_id'])
+    confere = _snapshot_confere(marcador)
+    if not confere:
+        app.logger.warning(f"Snapshot do gazetteer desatualizado (snapshot: {_gazetteer.linhas_locations} linhas, "
+                           f"maior ID {_gazetteer.max_id_locations}; LOCATIONS: {marcador[0]} linhas, maior ID {marcador[1]}). "
+                           "Usando o banco até rodar others/build_gazetteer_snapshot.py.")
+    _verificacao_gazetteer.update(confere=confere, verificado_em=agora, ttl=LOCALIDADES_CACHE_TTL_SECONDS)
+
+
+def gazetteer_atual():
+    """True se o snapshot existe e a última verificação não o encontrou desatualizado (não consulta o banco)."""
+    return bool(_gazetteer) and _verificacao_gazetteer['confere']
+
+
+def coordenadas_gazetteer(cidade_nome, bairro, rua):
+    """Coordenadas da rua pelo snapshot, ou None (snapshot ausente/desatualizado ou rua não encontrada)."""
+    if gazetteer_atual():
+        coordenadas = _gazetteer.coordenadas(cidade_nome, bairro, rua)
+        if coordenadas:
+            return coordenadas
+    verificar_gazetteer() # O chamador vai consultar LOCATIONS de qualquer forma
+    return None
+
+
+@app.context_processor
+def injetar_cidades():
+    # Lista de cidades para o seletor da barra de navegação (exibido só quando há mais de uma)
+    return {'cidades_disponiveis': lambda: sorted(carregar_cidades().values(), key=lambda c: c['nome'])}
+
+
+# --- Sprite atlas dos marcadores do mapa ---
+# Por cidade, uma imagem WebP com uma célula por caso aberto e um manifesto JSON (pet_id -> célula).
+# Cada versão do atlas tem uma chave única (hash do conteúdo), então pode ser cacheada
+# indefinidamente; o manifesto aponta para a versão atual. Toda leitura-alteração-escrita do
+# manifesto acontece sob trava_atlas(), que vale entre workers e instâncias.
+_sprites_lock = threading.Lock()
+_manifesto_cache = {} # slug da cidade -> {'dados': manifesto, 'carregado_em': instante}
+_atlas_cache = {} # slug da cidade -> (atlas_key, imagem): última versão conhecida por este processo
+
+
+def _prefixo_sprites(cidade_nome):
+    return f"{SPRITE_PREFIX}{slug_cidade(cidade_nome)}/"
+
+
+@contextmanager
+def trava_atlas(cidade_nome):
+    """Serializa as atualizações do atlas da cidade: _sprites_lock entre threads do processo e
+    GET_LOCK do MySQL entre processos (workers do gunicorn, instâncias da Vercel).
+
+    Lança TimeoutError se a trava não vier em SPRITE_LOCK_TIMEOUT_SECONDS e RuntimeError sem banco.
+    """
+    nome_trava = f"buscapet_atlas_{slug_cidade(cidade_nome)}"[:64] # Limite de tamanho do GET_LOCK
+    with _sprites_lock:
+        with conexao_compartilhada() as conn:
+            if not conn:
+                raise RuntimeError("Sem conexão com o banco para a trava do sprite atlas.")
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT GET_LOCK(%s, %s) AS TRAVA", (nome_trava, SPRITE_LOCK_TIMEOUT_SECONDS))
+                if not cursor.fetchone()['TRAVA']:
+                    raise TimeoutError(f"Trava do sprite atlas de {cidade_nome} ocupada.")
+            try:
+                yield
+            finally:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (nome_trava,))
+
+
+def _baixar_objeto_s3(s3_file_key):
+    """Baixa um objeto do S3 para a memória. Retorna None se não existir ou em caso de erro."""
+    if not s3_client:
+        return None
+    try:
+        return s3_client.get_object(Bucket=S3_BUCKET, Key=s3_file_key)['Body'].read()
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            app.logger.error(f"Erro do cliente S3 ao baixar {s3_file_key}: {e}")
+    except Exception as e:
+        app.logger.error(f"Erro inesperado ao baixar {s3_file_key} do S3: {e}")
+    return None
+
+
+def carregar_manifesto_sprites(cidade_nome, forcar=False):
+    """Retorna o manifesto do atlas da cidade (cacheado por SPRITE_MANIFEST_TTL_SECONDS) ou None se não houver."""
+    agora = time.monotonic()
+    cache = _manifesto_cache.get(slug_cidade(cidade_nome))
+    if not forcar and cache and cache['dados'] and agora - cache['carregado_em'] < SPRITE_MANIFEST_TTL_SECONDS:
+        return cache['dados']
+    conteudo = _baixar_objeto_s3(f"{_prefixo_sprites(cidade_nome)}manifest.json")
+    manifesto = None
+    if conteudo:
+        try:
+            manifesto = json.loads(conteudo)
+        except ValueError as e:
+            app.logger.error(f"Manifesto do sprite atlas de {cidade_nome} inválido: {e}")
+    _manifesto_cache[slug_cidade(cidade_nome)] = {'dados': manifesto, 'carregado_em': agora}
+    return manifesto
+
+
+def _celula_sprite(imagem):
+    # Recorte central quadrado, equivalente ao object-fit: cover do ícone
+    return ImageOps.fit(imagem.convert('RGBA'), (SPRITE_CELL_SIZE, SPRITE_CELL_SIZE))
+
+
+def _posicao_celula(indice):
+    return (indice % SPRITE_COLUMNS) * SPRITE_CELL_SIZE, (indice // SPRITE_COLUMNS) * SPRITE_CELL_SIZE
+
+
+def _publicar_manifesto(cidade_nome, manifesto):
+    s3_client.put_object(Bucket=S3_BUCKET, Key=f"{_prefixo_sprites(cidade_nome)}manifest.json",
+                         Body=json.dumps(manifesto).encode('utf-8'),
+                         ContentType='application/json', CacheControl='no-cache')
+    _manifesto_cache[slug_cidade(cidade_nome)] = {'dados': manifesto, 'carregado_em': time.monotonic()}
+
+
+def _enviar_atlas(atlas_key, atlas):
+    buffer = BytesIO()
+    atlas.save(buffer, format='WEBP', quality=80, method=4)
+    s3_client.put_object(Bucket=S3_BUCKET, Key=atlas_key, Body=buffer.getvalue(), ContentType='image/webp',
+                         CacheControl='public, max-age=31536000, immutable')
+
+
+def _apagar_celula(atlas, indice):
+    x, y = _posicao_celula(indice)
+    atlas.paste((0, 0, 0, 0), (x, y, x + SPRITE_CELL_SIZE, y + SPRITE_CELL_SIZE))
+
+
+def _apagar_celula_em_versao(atlas_key, indice):
+    """Regrava uma versão antiga do atlas, na mesma chave, com a célula apagada."""
+    conteudo = _baixar_objeto_s3(atlas_key)
+    if not conteudo:
+        return
+    with Image.open(BytesIO(conteudo)) as img:
+        atlas = img.convert('RGBA')
+    if _posicao_celula(indice)[1] < atlas.height:
+        _apagar_celula(atlas, indice)
+        _enviar_atlas(atlas_key, atlas)
+
+
+def _publicar_atlas(cidade_nome, atlas, manifesto, celula_removida=None):
+    """Envia uma nova versão do atlas e aponta o manifesto para ela.
+
+    As versões substituídas continuam no S3 enquanto podem ser referenciadas: a imediatamente anterior
+    (páginas já abertas) e as substituídas há menos de 2x SPRITE_MANIFEST_TTL_SECONDS (manifestos ainda
+    em cache em outros processos). Com celula_removida (caso resolvido), essa célula é apagada também
+    nessas versões, regravadas na mesma chave, para que a foto não continue pública.
+    """
+    buffer = BytesIO()
+    atlas.save(buffer, format='WEBP', quality=80, method=4)
+    atlas_key = f"{_prefixo_sprites(cidade_nome)}atlas_{hashlib.sha1(buffer.getvalue()).hexdigest()[:16]}.webp"
+    _enviar_atlas(atlas_key, atlas)
+
+    agora = time.time()
+    anteriores = manifesto.get('anteriores') or []
+    if manifesto.get('atlas_anterior'): # Manifestos gravados antes da lista de versões
+        anteriores.append({'key': manifesto['atlas_anterior'], 'substituido_em': agora})
+    if manifesto.get('atlas_key') and manifesto['atlas_key'] != atlas_key:
+        anteriores.append({'key': manifesto['atlas_key'], 'substituido_em': agora})
+    anteriores = [v for v in anteriores if v['key'] != atlas_key]
+    mantidas = [v for i, v in enumerate(anteriores)
+                if i == len(anteriores) - 1 or agora - v['substituido_em'] < 2 * SPRITE_MANIFEST_TTL_SECONDS]
+    if celula_removida is not None:
+        for versao in mantidas:
+            _apagar_celula_em_versao(versao['key'], celula_removida)
+
+    manifesto.pop('atlas_anterior', None)
+    manifesto.update(atlas_key=atlas_key, anteriores=mantidas, largura=atlas.width, altura=atlas.height)
+    _publicar_manifesto(cidade_nome, manifesto)
+    _atlas_cache[slug_cidade(cidade_nome)] = (atlas_key, atlas)
+    for versao in anteriores:
+        if versao not in mantidas:
+            delete_from_s3(S3_BUCKET, versao['key'])
+
+
+def _atlas_editavel(cidade_nome, manifesto):
+    """Cópia do atlas atual da cidade (do cache do processo ou do S3), ou None se o manifesto não servir."""
+    if not manifesto or manifesto.get('celula') != SPRITE_CELL_SIZE or manifesto.get('colunas') != SPRITE_COLUMNS:
+        return None
+    atlas_key_cache, atlas = _atlas_cache.get(slug_cidade(cidade_nome), (None, None))
+    if atlas_key_cache != manifesto.get('atlas_key'):
+        atlas = None
+    if atlas is None:
+        conteudo = _baixar_objeto_s3(manifesto.get('atlas_key')) if manifesto.get('atlas_key') else None
+        if not conteudo:
+            return None
+        with Image.open(BytesIO(conteudo)) as img:
+            atlas = img.convert('RGBA')
+    return atlas.copy() # A versão em cache pode estar sendo usada pela versão publicada
+
+
+def reconstruir_atlas_sprites(cidade_nome):
+    """Reconstrói o atlas da cidade do zero a partir dos thumbnails de todos os seus casos abertos.
+
+    Roda inteira sob trava_atlas(): um caso resolvido durante a reconstrução não volta para o atlas.
+    """
+    if not s3_client:
+        return False
+    try:
+        with trava_atlas(cidade_nome):
+            return _reconstruir_atlas_sprites(cidade_nome)
+    except (RuntimeError, TimeoutError, pymysql.MySQLError) as e:
+        app.logger.error(f"Erro ao reconstruir o sprite atlas de {cidade_nome}: {e}")
+        return False
+
+
+def _reconstruir_atlas_sprites(cidade_nome):
+    with conexao_compartilhada() as conn:
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT ID, THUMBNAIL_PATH FROM USERINPUT
+                    WHERE CIDADE = %s AND (RESOLVIDO = 0 OR RESOLVIDO IS NULL) AND THUMBNAIL_PATH IS NOT NULL
+                    ORDER BY ID
+                """, (cidade_nome,))
+                pets = cursor.fetchall()
+        except pymysql.MySQLError as e:
+            app.logger.error(f"Erro ao buscar thumbnails para o sprite atlas: {e}")
+            return False
+
+    celulas = []
+    for pet in pets:
+        conteudo = _baixar_objeto_s3(pet['THUMBNAIL_PATH'])
+        if not conteudo:
+            continue
+        try:
+            with Image.open(BytesIO(conteudo)) as img:
+                celulas.append((pet['ID'], _celula_sprite(img)))
+        except Exception as e:
+            app.logger.error(f"Thumbnail inválido para o pet ID {pet['ID']} no sprite atlas: {e}")
+
+    linhas = max(1, -(-len(celulas) // SPRITE_COLUMNS))
+    atlas = Image.new('RGBA', (SPRITE_COLUMNS * SPRITE_CELL_SIZE, linhas * SPRITE_CELL_SIZE), (0, 0, 0, 0))
+    manifesto = carregar_manifesto_sprites(cidade_nome, forcar=True) or {}
+    manifesto.update(celula=SPRITE_CELL_SIZE, colunas=SPRITE_COLUMNS, slots={}, livres=[])
+    for indice, (pet_id, celula) in enumerate(celulas):
+        atlas.paste(celula, _posicao_celula(indice))
+        manifesto['slots'][str(pet_id)] = indice
+    try:
+        _publicar_atlas(cidade_nome, atlas, manifesto)
+        app.logger.info(f"Sprite atlas de {cidade_nome} reconstruído com {len(celulas)} thumbnails.")
+        return True
+    except Exception as e:
+        app.logger.error(f"Erro ao publicar o sprite atlas: {e}")
+        return False
+
+
+def adicionar_ao_atlas(pet_id, thumbnail, cidade_nome):
+    """Insere o thumbnail de um novo caso no atlas da cidade (reaproveitando células livres) e publica nova versão.
+
+    Sem manifesto/atlas utilizável o caso fica fora do atlas (o marcador usa o próprio thumbnail): a
+    reconstrução completa lê todos os casos abertos e fica com others/rebuild_sprite_atlas.py.
+    """
+    if not s3_client:
+        return False
+    try:
+        with trava_atlas(cidade_nome):
+            manifesto = carregar_manifesto_sprites(cidade_nome, forcar=True)
+            atlas = _atlas_editavel(cidade_nome, manifesto)
+            if atlas is None:
+                app.logger.warning(f"Sprite atlas de {cidade_nome} indisponível: pet ID {pet_id} fica fora do atlas "
+                                   "até rodar others/rebuild_sprite_atlas.py.")
+                return False
+            livres = manifesto.setdefault('livres', [])
+            indice = livres.pop(0) if livres else len(manifesto['slots'])
+            _, y = _posicao_celula(indice)
+            if y + SPRITE_CELL_SIZE > atlas.height: # Acrescenta uma linha
+                expandido = Image.new('RGBA', (atlas.width, y + SPRITE_CELL_SIZE), (0, 0, 0, 0))
+                expandido.paste(atlas, (0, 0))
+                atlas = expandido
+            with Image.open(thumbnail) as img:
+                atlas.paste(_celula_sprite(img), _posicao_celula(indice))
+            manifesto['slots'][str(pet_id)] = indice
+            _publicar_atlas(cidade_nome, atlas, manifesto)
+            return True
+    except Exception as e:
+        app.logger.error(f"Erro ao adicionar o pet ID {pet_id} ao sprite atlas: {e}")
+        return False
+
+
+def remover_do_atlas(pet_id, cidade_nome):
+    """Libera a célula de um caso resolvido e a apaga do atlas, publicando uma nova versão sem a foto."""
+    if not s3_client:
+        return False
+    try:
+        with trava_atlas(cidade_nome):
+            manifesto = carregar_manifesto_sprites(cidade_nome, forcar=True)
+            if not manifesto or str(pet_id) not in manifesto.get('slots', {}):
+                return True
+            indice = manifesto['slots'].pop(str(pet_id))
+            manifesto.setdefault('livres', []).append(indice)
+            manifesto['livres'].sort()
+            atlas = _atlas_editavel(cidade_nome, manifesto)
+            if atlas is None:
+                # Só o manifesto: a célula deixa de ser referenciada e é reaproveitada no próximo cadastro
+                app.logger.warning(f"Sprite atlas de {cidade_nome} indisponível: célula do pet ID {pet_id} não foi apagada.")
+                _publicar_manifesto(cidade_nome, manifesto)
+                return True
+            _apagar_celula(atlas, indice)
+            _publicar_atlas(cidade_nome, atlas, manifesto, celula_removida=indice)
+        return True
+    except Exception as e:
+        app.logger.error(f"Erro ao remover o pet ID {pet_id} do sprite atlas: {e}")
+        return False
+
+
+def estilo_sprite(pet_id, manifesto):
+    """CSS inline que recorta a célula do pet no atlas, ou None se o pet não estiver no atlas."""
+    if not manifesto or not manifesto.get('atlas_key'):
+        return None
+    indice = manifesto.get('slots', {}).get(str(pet_id))
+    if indice is None:
+        return None
+    escala = MARKER_IMG_SIZE / manifesto['celula']
+    x = (indice % manifesto['colunas']) * manifesto['celula'] * escala
+    y = (indice // manifesto['colunas']) * manifesto['celula'] * escala
+    return (f"background-image: url('{s3_public_url(manifesto['atlas_key'])}'); "
+            f"background-size: {manifesto['largura'] * escala:g}px {manifesto['altura'] * escala:g}px; "
+            f"background-position: -{x:g}px -{y:g}px;")
+
+
+# --- Idempotência e controle de admissão (token bucket) das rotas de escrita ---
+# O estado fica em memória no processo: protege contra cliques duplos, reenvios do
+# navegador e rajadas de um mesmo cliente antes de qualquer processamento caro.
+_idempotencia_lock = threading.Lock()
+_idempotencia = {} # (endpoint, cliente, path, token) -> entrada com o resultado original
+_buckets_lock = threading.Lock()
+_buckets = {} # (endpoint, cliente) -> (tokens disponíveis, instante da última atualização)
+
+
+@app.context_processor
+def injetar_idempotency_key():
+    # Cada formulário renderizado recebe um token novo; reenvios do mesmo formulário repetem o token
+    return {'idempotency_key': lambda: secrets.token_urlsafe(16)}
+
+
+def identificar_cliente():
+    """Identifica o cliente pelo endereço remoto (já corrigido pelo ProxyFix quando há proxies confiáveis)."""
+    return request.remote_addr or 'desconhecido'
+
+
+def reservar_idempotencia(chave):
+    """Retorna (entrada, nova). Se nova for False, o token já foi usado dentro do TTL."""
+    agora = time.monotonic()
+    with _idempotencia_lock:
+        entrada = _idempotencia.get(chave)
+        if entrada and entrada['expira'] > agora:
+            return entrada, False
+        if len(_idempotencia) >= IDEMPOTENCY_MAX_ENTRIES:
+            for antiga in [c for c, e in _idempotencia.items() if e['expira'] <= agora]:
+                del _idempotencia[antiga]
+            # Ainda cheio: descarta as entradas concluídas mais antigas (ordem de inserção)
+            for antiga in [c for c, e in _idempotencia.items() if e['pronto'].is_set()][:IDEMPOTENCY_MAX_ENTRIES // 10]:
+                del _idempotencia[antiga]
+        entrada = {'expira': agora + IDEMPOTENCY_TTL_SECONDS, 'pronto': threading.Event(), 'resultado': None}
+        _idempotencia[chave] = entrada
+        return entrada, True
+
+
+def liberar_idempotencia(chave, entrada):
+    """Descarta a reserva (envio rejeitado ou com exceção) e libera quem estiver aguardando."""
+    with _idempotencia_lock:
+        if _idempotencia.get(chave) is entrada:
+            del _idempotencia[chave]
+    entrada['pronto'].set()
+
+
+def consumir_token(escopo, cliente, capacidade, por_minuto):
+    """Consome um token do balde do cliente. Retorna 0 em caso de sucesso, ou os segundos até o próximo token."""
+    agora = time.monotonic()
+    taxa = por_minuto / 60
+    chave = (escopo, cliente)
+    with _buckets_lock:
+        if len(_buckets) >= RATE_LIMIT_MAX_BUCKETS:
+            # Baldes que já teriam se enchido de novo são equivalentes a baldes inexistentes
+            for cheio in [c for c, (tokens, ultimo) in _buckets.items() if tokens + (agora - ultimo) * taxa >= capacidade]:
+                del _buckets[cheio]
+        tokens, ultimo = _buckets.get(chave, (capacidade, agora))
+        tokens = min(capacidade, tokens + (agora - ultimo) * taxa)
+        if tokens >= 1:
+            _buckets[chave] = (tokens - 1, agora)
+            return 0
+        _buckets[chave] = (tokens, agora)
+        return (1 - tokens) / taxa
+
+
+def rejeitar_escrita(mensagem, status_code, resposta_json, retry_after=None):
+    if resposta_json:
+        resposta = make_response(jsonify({"success": False, "message": mensagem}), status_code)
+    else:
+        flash(mensagem, "warning")
+        resposta = redirect(request.referrer or url_for('principal'))
+    if retry_after:
+        resposta.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return resposta
+
+
+def repetir_resultado_idempotente(entrada, resposta_json):
+    """Devolve o resultado do envio original, aguardando-o se ainda estiver em processamento."""
+    if not entrada['pronto'].wait(IDEMPOTENCY_WAIT_SECONDS) or entrada['resultado'] is None:
+        return rejeitar_escrita("Sua solicitação anterior ainda está sendo processada. Aguarde um instante.", 409, resposta_json)
+    status_code, headers, corpo, flashes = entrada['resultado']
+    # Mensagens flash do envio original que iriam para a próxima página (ex.: após redirect)
+    for categoria, mensagem in flashes:
+        flash(mensagem, categoria)
+    return app.response_class(corpo, status=status_code, headers=headers)
+
+
+def protecao_escrita(capacidade, por_minuto, resposta_json=False):
+    """Decorator para rotas POST: deduplica pelo token de idempotência e aplica token bucket por cliente.
+
+    O token vem do cabeçalho Idempotency-Key ou do campo de formulário idempotency_key.
+    Duplicatas não consomem tokens e recebem o resultado original.
+    """
+    def decorador(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'POST':
+                return view(*args, **kwargs)
+
+            cliente = identificar_cliente()
+            token = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+            chave, entrada = None, None
+            if token:
+                chave = (request.endpoint, cliente, request.path, token)
+                entrada, nova = reservar_idempotencia(chave)
+                if not nova:
+                    app.logger.info(f"Envio duplicado ignorado em {request.endpoint} (cliente {cliente}).")
+                    return repetir_resultado_idempotente(entrada, resposta_json)
+
+            espera = consumir_token(request.endpoint, cliente, capacidade, por_minuto)
+            if espera:
+                if entrada:
+                    liberar_idempotencia(chave, entrada)
+                app.logger.warning(f"Limite de envios excedido em {request.endpoint} (cliente {cliente}).")
+                return rejeitar_escrita("Muitas solicitações em pouco tempo. Aguarde alguns instantes e tente novamente.",
+                                        429, resposta_json, retry_after=espera)
+
+            if not entrada:
+                return view(*args, **kwargs)
+
+            flashes_antes = len(session.get('_flashes', []))
+            try:
+                resposta = make_response(view(*args, **kwargs))
+            except Exception:
+                liberar_idempotencia(chave, entrada)
+                raise
+            # O cookie de sessão não é guardado: as mensagens flash são repetidas pela sessão atual
+            headers = [(k, v) for k, v in resposta.headers if k.lower() != 'set-cookie']
+            flashes = list(session.get('_flashes', [])[flashes_antes:])
+            entrada['resultado'] = (resposta.status_code, headers, resposta.get_data(), flashes)
+            entrada['pronto'].set()
+            return resposta
+        return wrapper
+    return decorador
+
+
+def renderizar_mapa_folium(pets, centro, zoom, manifesto_sprites):
+    """Renderizador original: um DivIcon, IFrame e Popup do folium por pet."""
+    mapa_folium = folium.Map(location=centro, zoom_start=zoom, tiles="CartoDB positron")
+
+    for pet in pets:
+        if pet.get('LATITUDE') and pet.get('LONGITUDE') and pet.get('THUMBNAIL_PATH'):
+            
+            detalhes_pet_url = url_for('detalhes_pet', pet_id=pet['ID'], _external=True)
+            status_pet_mapa = pet.get('STATUS_PET', 'Perdi meu PET')
+            
+            icon_border_color = "red"
+            if status_pet_mapa == "Encontrei um PET":
+                icon_border_color = "green"
+
+            # Foto recortada do sprite atlas (uma única imagem para todo o mapa);
+            # pets ainda fora do atlas usam o próprio thumbnail
+            sprite_css = estilo_sprite(pet['ID'], manifesto_sprites)
+            if sprite_css:
+                foto_icone_html = f'<div style="width: 48px; height: 48px; border-radius: 50%; {sprite_css}"></div>'
+            else:
+                thumbnail_url_para_icone = s3_public_url(pet.get('THUMBNAIL_PATH'))
+                foto_icone_html = f"""<img src="{thumbnail_url_para_icone}" alt="T" 
+                     style="width: 48px; height: 48px; border-radius: 50%; object-fit: cover;">"""
+
+            icon_html = f"""
+            <div style="
+                width: 52px; height: 52px; border-radius: 50%;
+                background-color: {icon_border_color}; display: flex;
+                justify-content: center; align-items: center;
+                box-shadow: 0px 0px 5px rgba(0,0,0,0.5); padding: 2px;">
+                {foto_icone_html}
+            </div>
+            """
+            custom_map_icon = folium.DivIcon(
+                icon_size=(52, 52),
+                icon_anchor=(26, 52),
+                html=icon_html
+            )
+            
+            popup_html_content = f"""
+            <div style="font-family: 'Nunito', sans-serif; text-align:center; min-width:180px; padding: 10px;">
+                <strong style="font-size: 1.1em; color: #2D3748;">{pet.get('NOME_PET', 'Pet')}</strong><br>
+                <span style="font-size: 0.9em; color: #6A7588;">({pet.get('ESPECIE', '')})</span><br>
+                <a href="{detalhes_pet_url}" target="_blank" class="popup-details-link"> 
+                   Ver Detalhes do PET
+                </a>
+            </div>
+            """
+            popup_styles = """
+            <style>
+                body { margin:0; font-family: 'Nunito', sans-serif; }
+                .popup-details-link {
+                    display: inline-block; margin-top: 8px; padding: 6px 12px;
+                    background-color: #4A90E2; color: white !important; text-decoration: none;
+                    border-radius: 20px; font-weight: 600; font-size: 0.9em;
+                    transition: background-color 0.2s ease;
+                }
+                .popup-details-link:hover { background-color: #357ABD; }
+            </style>
+            """
+            full_popup_html = popup_styles + popup_html_content
+            
+            iframe = folium.IFrame(full_popup_html, width=220, height=110)
+            popup = folium.Popup(iframe, max_width=220)
+            
+            marker = folium.Marker(
+                location=[pet['LATITUDE'], pet['LONGITUDE']],
+                icon=custom_map_icon,
+                tooltip=f"<strong>{pet.get('NOME_PET', 'Pet')}</strong><br>Status: {status_pet_mapa}<br>Clique para mais informações"
+            )
+            marker.add_child(popup)
+            marker.add_to(mapa_folium)
+
+    return mapa_folium._repr_html_()
+
+
+def renderizar_mapa_leve(pets, centro, zoom, manifesto_sprites):
+    """Gera o mesmo mapa com uma folha de estilos compartilhada, um array JSON compacto
+    de marcadores e um único laço de Leaflet no cliente (templates/mapa_leaflet.html)."""
+    sprite = None
+    if manifesto_sprites and manifesto_sprites.get('atlas_key'):
+        escala = MARKER_IMG_SIZE / manifesto_sprites['celula']
+        sprite = {
+            "url": s3_public_url(manifesto_sprites['atlas_key']),
+            "largura": round(manifesto_sprites['largura'] * escala, 2),
+            "altura": round(manifesto_sprites['altura'] * escala, 2),
+            "colunas": manifesto_sprites['colunas'],
+            "celula": MARKER_IMG_SIZE,
+        }
+    slots = (manifesto_sprites or {}).get('slots', {}) if sprite else {}
+
+    # [lat, lon, id, nome, espécie, encontrado (0/1), célula no atlas (-1 = fora), thumbnail]
+    marcadores = []
+    for pet in pets:
+        if pet.get('LATITUDE') and pet.get('LONGITUDE') and pet.get('THUMBNAIL_PATH'):
+            slot = slots.get(str(pet['ID']))
+            marcadores.append([
+                round(float(pet['LATITUDE']), 6),
+                round(float(pet['LONGITUDE']), 6),
+                pet['ID'],
+                pet.get('NOME_PET', 'Pet'),
+                pet.get('ESPECIE', ''),
+                1 if pet.get('STATUS_PET', 'Perdi meu PET') == "Encontrei um PET" else 0,
+                -1 if slot is None else slot,
+                '' if slot is not None else s3_public_url(pet.get('THUMBNAIL_PATH')),
+            ])
+
+    # Placeholder numérico substituído no cliente pelo ID de cada pet
+    detalhes_url = url_for('detalhes_pet', pet_id=999999999, _external=True).replace('999999999', '{id}')
+    documento = render_template('mapa_leaflet.html',
+                                centro=[float(centro[0]), float(centro[1])],
+                                zoom=zoom,
+                                marcadores=marcadores,
+                                sprite=sprite,
+                                detalhes_url=detalhes_url)
+    # Mesmo invólucro responsivo (iframe com srcdoc) que o folium usa em _repr_html_
+    return ('<div style="width:100%;"><div style="position:relative;width:100%;height:0;padding-bottom:60%;">'
+            f'<iframe srcdoc="{escape(documento)}" style="position:absolute;width:100%;height:100%;left:0;top:0;'
+            'border:none !important;" allowfullscreen webkitallowfullscreen mozallowfullscreen></iframe></div></div>')
+
+
+def renderizar_mapa(pets, centro, zoom, cidade_nome):
+    manifesto_sprites = carregar_manifesto_sprites(cidade_nome) if pets else None
+    renderizador = renderizar_mapa_folium if MAP_RENDERER == 'folium' else renderizar_mapa_leve
+    return renderizador(pets, centro, zoom, manifesto_sprites)
+
+
+def centro_do_mapa(pets, cidade):
+    """Média das coordenadas dos pets dentro dos limites da cidade (ignora geocodificações fora dela)."""
+    limites = cidade.get('limites')
+    coords = [(float(p['LATITUDE']), float(p['LONGITUDE'])) for p in pets if p.get('LATITUDE') and p.get('LONGITUDE')]
+    if limites:
+        (lat_min, lon_min), (lat_max, lon_max) = limites
+        coords = [(lat, lon) for lat, lon in coords if lat_min <= lat <= lat_max and lon_min <= lon <= lon_max]
+    if not coords:
+        return cidade['centro']
+    return [sum(lat for lat, _ in coords) / len(coords), sum(lon for _, lon in coords) / len(coords)]
+
+
 @app.route('/')
-def principal():
-    conn = open_conn()
+@app.route('/cidade/<cidade_slug>')
+def principal(cidade_slug=None):
+    cidade = obter_cidade(cidade_slug)
+    if not cidade:
+        return cidade_nao_encontrada('principal', cidade_slug)
+
+    conn = conexao_requisicao()
     if not conn:
         flash("Erro de conexão com o banco de dados.", "danger")
-        return render_template('index.html', current_year=datetime.now().year, mapa_html=None)
+        return render_template('index.html', current_year=datetime.now().year, mapa_html=None, cidade=cidade)
 
-    mapa_folium = None
     try:
         with conn.cursor() as cursor:
             sql = """
                 SELECT ID, NOME_PET, ESPECIE, BAIRRO, STATUS_PET, THUMBNAIL_PATH, LATITUDE, LONGITUDE
                 FROM USERINPUT 
-                WHERE RESOLVIDO = 0 OR RESOLVIDO IS NULL 
+                WHERE CIDADE = %s AND (RESOLVIDO = 0 OR RESOLVIDO IS NULL)
                 ORDER BY CREATED_AT DESC
             """
-            cursor.execute(sql)
+            cursor.execute(sql, (cidade['nome'],))
             pets_no_mapa = cursor.fetchall()
 
         if pets_no_mapa:
-            avg_lat = sum(p['LATITUDE'] for p in pets_no_mapa if p.get('LATITUDE')) / len([p for p in pets_no_mapa if p.get('LATITUDE')]) if any(p.get('LATITUDE') for p in pets_no_mapa) else -22.7532
-            avg_lon = sum(p['LONGITUDE'] for p in pets_no_mapa if p.get('LONGITUDE')) / len([p for p in pets_no_mapa if p.get('LONGITUDE')]) if any(p.get('LONGITUDE') for p in pets_no_mapa) else -47.3330
-            
-            mapa_folium = folium.Map(location=[avg_lat, avg_lon], zoom_start=13, tiles="CartoDB positron")
-
-            for pet in pets_no_mapa:
-                if pet.get('LATITUDE') and pet.get('LONGITUDE') and pet.get('THUMBNAIL_PATH'):
-                    
-                    detalhes_pet_url = url_for('detalhes_pet', pet_id=pet['ID'], _external=True)
-                    status_pet_mapa = pet.get('STATUS_PET', 'Perdi meu PET')
-                    
-                    thumbnail_s3_key = pet.get('THUMBNAIL_PATH')
-                    thumbnail_url_para_icone = f"https://{S3_BUCKET}.s3.{S3_REGION}.amazonaws.com/{thumbnail_s3_key}" if thumbnail_s3_key and S3_BUCKET and S3_REGION else '#'
-                    
-                    icon_border_color = "red"
-                    if status_pet_mapa == "Encontrei um PET":
-                        icon_border_color = "green"
-                    
-                    icon_html = f"""
-                    <div style="
-                        width: 52px; height: 52px; border-radius: 50%;
-                        background-color: {icon_border_color}; display: flex;
-                        justify-content: center; align-items: center;
-                        box-shadow: 0px 0px 5px rgba(0,0,0,0.5); padding: 2px;">
-                        <img src="{thumbnail_url_para_icone}" alt="T" 
-                             style="width: 48px; height: 48px; border-radius: 50%; object-fit: cover;">
-                    </div>
-                    """
-                    custom_map_icon = folium.DivIcon(
-                        icon_size=(52, 52),
-                        icon_anchor=(26, 52),
-                        html=icon_html
-                    )
-                    
-                    popup_html_content = f"""
-                    <div style="font-family: 'Nunito', sans-serif; text-align:center; min-width:180px; padding: 10px;">
-                        <strong style="font-size: 1.1em; color: #2D3748;">{pet.get('NOME_PET', 'Pet')}</strong><br>
-                        <span style="font-size: 0.9em; color: #6A7588;">({pet.get('ESPECIE', '')})</span><br>
-                        <a href="{detalhes_pet_url}" target="_blank" class="popup-details-link"> 
-                           Ver Detalhes do PET
-                        </a>
-                    </div>
-                    """
-                    popup_styles = """
-                    <style>
-                        body { margin:0; font-family: 'Nunito', sans-serif; }
-                        .popup-details-link {
-                            display: inline-block; margin-top: 8px; padding: 6px 12px;
-                            background-color: #4A90E2; color: white !important; text-decoration: none;
-                            border-radius: 20px; font-weight: 600; font-size: 0.9em;
-                            transition: background-color 0.2s ease;
-                        }
-                        .popup-details-link:hover { background-color: #357ABD; }
-                    </style>
-                    """
-                    full_popup_html = popup_styles + popup_html_content
-                    
-                    iframe = folium.IFrame(full_popup_html, width=220, height=110)
-                    popup = folium.Popup(iframe, max_width=220)
-                    
-                    marker = folium.Marker(
-                        location=[pet['LATITUDE'], pet['LONGITUDE']],
-                        icon=custom_map_icon,
-                        tooltip=f"<strong>{pet.get('NOME_PET', 'Pet')}</strong><br>Status: {status_pet_mapa}<br>Clique para mais informações"
-                    )
-                    marker.add_child(popup)
-                    marker.add_to(mapa_folium)
-
-            mapa_html = mapa_folium._repr_html_() if mapa_folium else "<p class='text-center alert alert-info'>Nenhum pet perdido para exibir no mapa no momento.</p>"
+            mapa_html = renderizar_mapa(pets_no_mapa, centro_do_mapa(pets_no_mapa, cidade), cidade['zoom'], cidade['nome'])
         else:
-            mapa_folium = folium.Map(location=[-22.7532, -47.3330], zoom_start=12, tiles="CartoDB positron")
-            mapa_html = mapa_folium._repr_html_()
+            mapa_html = renderizar_mapa([], cidade['centro'], cidade['zoom'] - 1, cidade['nome'])
             if not app.debug: # Não mostrar flash se for só o mapa vazio em debug
                  flash("Nenhum pet cadastrado como perdido ou encontrado no momento.", "info")
             
     except pymysql.MySQLError as e:
-        app.logger.error(f"Erro ao buscar pets para o mapa: {e}")
+        app.logger.error(f"Erro ao buscar pets para o mapa de {cidade['nome']}: {e}")
         flash("Erro ao carregar dados dos pets.", "danger")
         mapa_html = "<p class='text-center alert alert-danger'>Erro ao carregar o mapa. Tente novamente mais tarde.</p>"
     except Exception as e_geral: # Captura outros erros inesperados
         app.logger.error(f"Erro geral na rota principal: {e_geral}")
         flash("Ocorreu um erro inesperado ao carregar a página principal.", "danger")
         # Retorna um mapa vazio em caso de erro não previsto para não quebrar a página
-        mapa_folium_erro = folium.Map(location=[-22.7532, -47.3330], zoom_start=12, tiles="CartoDB positron")
-        mapa_html = mapa_folium_erro._repr_html_()
-    finally:
-        if conn:
-            conn.close()
-            
+        mapa_html = renderizar_mapa([], cidade['centro'], cidade['zoom'] - 1, cidade['nome'])
+
     return render_template('index.html', 
                            current_year=datetime.now().year, 
-                           mapa_html=mapa_html)
+                           mapa_html=mapa_html,
+                           cidade=cidade)
+
+
+# --- Arquivo de casos resolvidos (tabelas preenchidas por others/arquivar_resolvidos.py) ---
+def consultar_arquivo(cursor, sql, params):
+    """Leitura em USERINPUT_ARQUIVO/MESSAGES_ARQUIVO. Se o banco ainda não tem essas tabelas, devolve lista vazia."""
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    except pymysql.err.ProgrammingError as e:
+        app.logger.warning(f"Tabelas de arquivo indisponíveis: {e}")
+        return []
 
 
 @app.route('/pet/<int:pet_id>')
 def detalhes_pet(pet_id):
-    conn = open_conn()
+    conn = conexao_requisicao()
     if not conn:
         flash("Erro de conexão com o banco de dados.", "danger")
         return redirect(url_for('principal'))
@@ -289,33 +1304,34 @@ def detalhes_pet(pet_id):
             sql_pet = """
                 SELECT ID, NOME_PET, ESPECIE, RUA, BAIRRO, CIDADE, CONTATO, COMENTARIO, 
                        FOTO_PATH, THUMBNAIL_PATH, CREATED_AT, STATUS_PET, RESOLVIDO, RESOLVIDO_AT 
-                FROM USERINPUT 
+                FROM {tabela} 
                 WHERE ID = %s
             """ # Adicionado THUMBNAIL_PATH e RESOLVIDO_AT se precisar
-            cursor.execute(sql_pet, (pet_id,))
+            sql_messages = """
+                SELECT MessageID, CommenterName, MessageText, CreatedAt
+                FROM {tabela}
+                WHERE PetID = %s
+                ORDER BY CreatedAt DESC
+                LIMIT 3 
+            """
+            cursor.execute(sql_pet.format(tabela='USERINPUT'), (pet_id,))
             pet_info = cursor.fetchone()
 
             if pet_info:
-                sql_messages = """
-                    SELECT MessageID, CommenterName, MessageText, CreatedAt
-                    FROM MESSAGES
-                    WHERE PetID = %s
-                    ORDER BY CreatedAt DESC
-                    LIMIT 3 
-                """
-                cursor.execute(sql_messages, (pet_id,))
+                cursor.execute(sql_messages.format(tabela='MESSAGES'), (pet_id,))
                 latest_messages = cursor.fetchall()
-            else: # Pet não encontrado
-                flash("Pet não encontrado.", "warning")
-                return redirect(url_for('principal'))
+            else: # Casos resolvidos há mais tempo foram arquivados com o mesmo ID
+                arquivado = consultar_arquivo(cursor, sql_pet.format(tabela='USERINPUT_ARQUIVO'), (pet_id,))
+                if not arquivado: # Pet não encontrado
+                    flash("Pet não encontrado.", "warning")
+                    return redirect(url_for('principal'))
+                pet_info = arquivado[0]
+                latest_messages = consultar_arquivo(cursor, sql_messages.format(tabela='MESSAGES_ARQUIVO'), (pet_id,))
 
     except pymysql.MySQLError as e:
         app.logger.error(f"Erro ao buscar detalhes do pet ID {pet_id}: {e}")
         flash("Erro ao carregar informações do pet.", "danger")
         return redirect(url_for('principal'))
-    finally:
-        if conn:
-            conn.close()
 
     # Se pet_info ainda for None aqui, significa que o pet não foi encontrado (já tratado acima)
     # Mas por segurança, adicionamos uma verificação, embora o redirect já devesse ter ocorrido.
@@ -346,50 +1362,49 @@ def detalhes_pet(pet_id):
 
 
 @app.route('/encerrar_busca/<int:pet_id>', methods=['POST'])
+@protecao_escrita(capacidade=5, por_minuto=10, resposta_json=True)
 def encerrar_busca(pet_id):
-    conn = open_conn()
+    conn = conexao_requisicao()
     if not conn:
         return jsonify({"success": False, "message": "Erro de conexão com o banco."})
     try:
-        with conn.cursor() as cursor:
+        with transacao(conn) as cursor:
+            resolvido_at = datetime.now()
             sql = "UPDATE USERINPUT SET RESOLVIDO = 1, RESOLVIDO_AT = %s WHERE ID = %s AND (RESOLVIDO = 0 OR RESOLVIDO IS NULL)"
-            affected_rows = cursor.execute(sql, (datetime.now(), pet_id))
-            conn.commit()
+            affected_rows = cursor.execute(sql, (resolvido_at, pet_id))
+            pet_resolvido = registrar_resolucao_stats(cursor, pet_id, resolvido_at) if affected_rows > 0 else None
         if affected_rows > 0:
+            if pet_resolvido:
+                remover_do_atlas(pet_id, pet_resolvido['CIDADE'])
             return jsonify({"success": True, "message": "Busca encerrada com sucesso!"})
         else:
             return jsonify({"success": False, "message": "Pet não encontrado ou busca já encerrada."})
     except pymysql.MySQLError as e:
         app.logger.error(f"Erro ao encerrar busca para pet ID {pet_id}: {e}")
         return jsonify({"success": False, "message": "Erro ao atualizar o banco de dados."})
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/cadastrar-pet', methods=['GET', 'POST'])
+@protecao_escrita(capacidade=3, por_minuto=6)
 def cadastrar_pet():
-    # Tenta abrir a conexão para buscar bairros, mas apenas se for GET
-    # Para POST, a conexão será aberta dentro do bloco de processamento se necessário
-    conn_for_bairros = None
-    if request.method == 'GET':
-        conn_for_bairros = open_conn()
-        if not conn_for_bairros:
-            flash("Erro de conexão com o banco de dados. Não é possível carregar os bairros.", "danger")
-            # Mesmo com erro, renderiza o template para o usuário ver a mensagem
-            return render_template('cadastrar_pet.html', bairros=[]) 
+    # Cidade do cadastro: ?cidade=<slug> no GET, campo 'cidade' (nome) no POST; padrão CIDADE_PADRAO
+    cidade_sel = obter_cidade(request.values.get('cidade'))
+    if not cidade_sel:
+        flash("Cidade não atendida pela plataforma.", "danger")
+        return render_template('cadastrar_pet.html', bairros=[], cidade=obter_cidade())
 
+    # Busca os bairros da cidade (cache em memória por cidade), mas apenas se for GET
     bairros = []
-    if conn_for_bairros: # Se a conexão foi bem-sucedida para GET
+    if request.method == 'GET':
         try:
-            with conn_for_bairros.cursor() as cursor:
-                cursor.execute("SELECT DISTINCT BAIRRO FROM LOCATIONS ORDER BY BAIRRO ASC;")
-                bairros_data = cursor.fetchall()
-                bairros = [row['BAIRRO'] for row in bairros_data]
+            bairros = listar_bairros(cidade_sel['nome'])
         except pymysql.MySQLError as e:
-            app.logger.error(f"Erro ao buscar bairros: {e}")
+            app.logger.error(f"Erro ao buscar bairros de {cidade_sel['nome']}: {e}")
             flash("Erro ao carregar lista de bairros.", "danger")
-        finally:
-            conn_for_bairros.close()
+            bairros = []
+        if bairros is None:
+            flash("Erro de conexão com o banco de dados. Não é possível carregar os bairros.", "danger")
+            # Mesmo com erro, renderiza o template para o usuário ver a mensagem
+            return render_template('cadastrar_pet.html', bairros=[], cidade=cidade_sel)
 
     if request.method == 'POST':
         # Obter dados do formulário
@@ -397,7 +1412,7 @@ def cadastrar_pet():
         especie = request.form.get('especie')
         rua = request.form.get('rua')
         bairro = request.form.get('bairro')
-        cidade = request.form.get('cidade', 'Americana/SP')
+        cidade = cidade_sel['nome']
         contato = request.form.get('contato')
         comentario = request.form.get('comentario')
         status_pet = request.form.get('status_pet', 'Perdi meu PET')
@@ -405,45 +1420,39 @@ def cadastrar_pet():
         # Validação do arquivo
         if 'foto_pet' not in request.files or not request.files['foto_pet'].filename:
             flash('Nenhuma foto selecionada ou arquivo inválido!', 'danger')
-            return render_template('cadastrar_pet.html', bairros=bairros) # Re-renderiza com bairros
+            return render_template('cadastrar_pet.html', bairros=bairros, cidade=cidade_sel) # Re-renderiza com bairros
         
         file = request.files['foto_pet']
 
         if not (file and allowed_file(file.filename)):
             flash('Tipo de arquivo não permitido!', 'danger')
-            return render_template('cadastrar_pet.html', bairros=bairros)
+            return render_template('cadastrar_pet.html', bairros=bairros, cidade=cidade_sel)
 
-        # Gerar nomes de arquivo e caminhos
+        # Gerar nomes de arquivo
         # Adicionar microssegundos para maior unicidade em caso de uploads rápidos
         filename_base = secure_filename(file.filename)
         timestamp_str = datetime.now().strftime('%Y%m%d%H%M%S%f') 
         unique_filename = f"{timestamp_str}_{filename_base}"
-        
-        original_tmp_dir, thumbnail_tmp_dir = ensure_tmp_upload_dir()
-
-        temp_original_filepath = os.path.join(original_tmp_dir, unique_filename)
-        temp_thumbnail_filename = f"thumb_{unique_filename}"
-        temp_thumbnail_filepath = os.path.join(thumbnail_tmp_dir, temp_thumbnail_filename)
 
         # Definir chaves S3
         s3_original_key = f"uploads/imagens_pet/{unique_filename}"
-        s3_thumbnail_key = f"uploads/thumbnails_pet/{temp_thumbnail_filename}"
+        s3_thumbnail_key = f"uploads/thumbnails_pet/thumb_{unique_filename}"
         
         foto_url_s3 = None
         thumbnail_url_s3 = None
 
         try:
-            file.save(temp_original_filepath) # Salva no /tmp primeiro
-            
-            if create_thumbnail(temp_original_filepath, temp_thumbnail_filepath):
+            # Thumbnail gerado direto do stream do upload (sem cópia em /tmp); a foto original vai como veio
+            thumbnail_bytes = create_thumbnail(file.stream)
+            if thumbnail_bytes:
                 # Upload para S3
                 content_type = file.content_type or 'application/octet-stream' # Default content type
                 
                 app.logger.info(f"Tentando upload da imagem original para S3: {s3_original_key}")
-                foto_url_s3 = upload_to_s3(temp_original_filepath, S3_BUCKET, s3_original_key, content_type=content_type)
+                foto_url_s3 = upload_to_s3(file.stream, S3_BUCKET, s3_original_key, content_type=content_type)
                 
                 app.logger.info(f"Tentando upload do thumbnail para S3: {s3_thumbnail_key}")
-                thumbnail_url_s3 = upload_to_s3(temp_thumbnail_filepath, S3_BUCKET, s3_thumbnail_key, content_type=content_type)
+                thumbnail_url_s3 = upload_to_s3(BytesIO(thumbnail_bytes), S3_BUCKET, s3_thumbnail_key, content_type=content_type)
 
                 if not (foto_url_s3 and thumbnail_url_s3):
                     flash('Erro ao fazer upload das imagens para o armazenamento na nuvem. Tente novamente.', 'danger')
@@ -452,36 +1461,37 @@ def cadastrar_pet():
                     if thumbnail_url_s3: delete_from_s3(S3_BUCKET, s3_thumbnail_key)
                     raise Exception("Falha no upload para o S3") # Força o bloco except abaixo
 
-                # Obter coordenadas da tabela LOCATIONS
+                conn = conexao_requisicao() # A mesma conexão atende a busca de coordenadas e a inserção
+
+                # Obter coordenadas: snapshot do gazetteer (mmap) e, na falta dele, tabela LOCATIONS
                 lat, lon = None, None
-                conn_coords = open_conn() # Nova conexão para buscar coordenadas
-                if conn_coords:
+                coords_snapshot = coordenadas_gazetteer(cidade, bairro, rua) if bairro and rua else None
+                if coords_snapshot:
+                    lat, lon = coords_snapshot
+                elif not conn:
+                    flash('Não foi possível conectar ao banco para buscar coordenadas.', 'warning')
+                elif not (bairro and rua):
+                    flash('Bairro ou rua não fornecidos para busca de coordenadas.', 'warning')
+                else:
                     try:
-                        if bairro and rua:
-                            with conn_coords.cursor() as cursor_coords:
-                                sql_coords = "SELECT LATITUDE, LONGITUDE FROM LOCATIONS WHERE BAIRRO = %s AND RUA = %s LIMIT 1"
-                                cursor_coords.execute(sql_coords, (bairro, rua))
-                                coords_data = cursor_coords.fetchone()
-                                if coords_data:
-                                    lat, lon = coords_data['LATITUDE'], coords_data['LONGITUDE']
-                                else:
-                                    flash(f'Coordenadas não encontradas para {rua}, {bairro}. O pet será cadastrado sem geolocalização precisa no mapa.', 'warning')
-                        else:
-                            flash('Bairro ou rua não fornecidos para busca de coordenadas.', 'warning')
+                        with conn.cursor() as cursor_coords:
+                            sql_coords = "SELECT LATITUDE, LONGITUDE FROM LOCATIONS WHERE CIDADE = %s AND BAIRRO = %s AND RUA = %s LIMIT 1"
+                            cursor_coords.execute(sql_coords, (cidade, bairro, rua))
+                            coords_data = cursor_coords.fetchone()
+                            if coords_data:
+                                lat, lon = coords_data['LATITUDE'], coords_data['LONGITUDE']
+                            else:
+                                flash(f'Coordenadas não encontradas para {rua}, {bairro}. O pet será cadastrado sem geolocalização precisa no mapa.', 'warning')
                     except pymysql.MySQLError as e_coords:
                         app.logger.error(f"Erro ao buscar coordenadas: {e_coords}")
                         flash('Erro ao obter coordenadas. O pet será cadastrado sem geolocalização precisa.', 'warning')
-                    finally:
-                        conn_coords.close()
-                else:
-                    flash('Não foi possível conectar ao banco para buscar coordenadas.', 'warning')
 
 
                 # Salvar no banco de dados as CHAVES S3
-                conn_db_insert = open_conn()
-                if conn_db_insert:
+                if conn:
                     try:
-                        with conn_db_insert.cursor() as cursor_insert:
+                        with transacao(conn) as cursor_insert:
+                            created_at = datetime.now()
                             sql_insert = """
                                 INSERT INTO USERINPUT 
                                 (NOME_PET, ESPECIE, RUA, BAIRRO, CIDADE, CONTATO, COMENTARIO, 
@@ -491,73 +1501,56 @@ def cadastrar_pet():
                             """
                             cursor_insert.execute(sql_insert, 
                                                 (nome_pet, especie, rua, bairro, cidade, contato, comentario,
-                                                s3_original_key, s3_thumbnail_key, datetime.now(), lat, lon,
+                                                s3_original_key, s3_thumbnail_key, created_at, lat, lon,
                                                 status_pet))
-                            conn_db_insert.commit()
-                            flash('Pet cadastrado com sucesso!', 'success')
-                            # Limpar arquivos temporários somente após tudo dar certo
-                            if os.path.exists(temp_original_filepath): os.remove(temp_original_filepath)
-                            if os.path.exists(temp_thumbnail_filepath): os.remove(temp_thumbnail_filepath)
-                            return redirect(url_for('principal'))
-                    except pymysql.MySQLError as e_db:
+                            novo_pet_id = cursor_insert.lastrowid
+                            registrar_novo_caso_stats(cursor_insert, created_at, cidade, bairro, especie)
+                            atualizar_termos_comentario(cursor_insert, cidade, comentario, 1)
+                        flash('Pet cadastrado com sucesso!', 'success')
+                        adicionar_ao_atlas(novo_pet_id, BytesIO(thumbnail_bytes), cidade)
+                        return redirect(url_for('principal', cidade_slug=cidade_sel['slug'])) # Mapa da cidade do cadastro
+                    except pymysql.MySQLError as e_db: # transacao() já desfez a inserção
                         app.logger.error(f"Erro ao inserir pet no banco: {e_db}")
                         flash(f'Erro ao salvar dados no banco: {e_db}', 'danger')
-                        conn_db_insert.rollback()
                         # Se falhar ao salvar no DB, deletar do S3 para manter consistência
                         if foto_url_s3: delete_from_s3(S3_BUCKET, s3_original_key)
                         if thumbnail_url_s3: delete_from_s3(S3_BUCKET, s3_thumbnail_key)
-                    finally:
-                        conn_db_insert.close()
                 else: # Falha ao conectar para inserir no DB
                      flash('Erro de conexão com o banco ao tentar salvar o pet.', 'danger')
                      if foto_url_s3: delete_from_s3(S3_BUCKET, s3_original_key)
                      if thumbnail_url_s3: delete_from_s3(S3_BUCKET, s3_thumbnail_key)
 
             else: # Falha ao criar thumbnail
-                flash('Erro ao processar a imagem (não foi possível criar miniatura).', 'danger')
+                flash(f'Erro ao processar a imagem (arquivo inválido ou acima de {MAX_IMAGE_PIXELS // 1_000_000} megapixels).', 'danger')
         
-        except Exception as e_file_proc: # Captura erros de file.save, create_thumbnail, S3 uploads
+        except Exception as e_file_proc: # Captura erros de leitura da foto, create_thumbnail, S3 uploads
             app.logger.error(f"Erro no processamento do arquivo ou upload S3: {e_file_proc}")
             flash(f'Ocorreu um erro ao processar o arquivo da foto: {e_file_proc}', 'danger')
-        finally: 
-            # Garantir limpeza dos arquivos temporários em caso de qualquer erro no try principal
-            if 'temp_original_filepath' in locals() and os.path.exists(temp_original_filepath):
-                try: os.remove(temp_original_filepath)
-                except OSError as e_os_remove: app.logger.error(f"Erro ao remover temp original: {e_os_remove}")
-            if 'temp_thumbnail_filepath' in locals() and os.path.exists(temp_thumbnail_filepath):
-                try: os.remove(temp_thumbnail_filepath)
-                except OSError as e_os_remove: app.logger.error(f"Erro ao remover temp thumbnail: {e_os_remove}")
         
         # Se chegou aqui após um erro no POST, re-renderiza o formulário com mensagens e bairros
-        return render_template('cadastrar_pet.html', bairros=bairros)
+        return render_template('cadastrar_pet.html', bairros=bairros, cidade=cidade_sel)
 
     # Para GET request, apenas renderiza o formulário com a lista de bairros
-    return render_template('cadastrar_pet.html', bairros=bairros)
+    return render_template('cadastrar_pet.html', bairros=bairros, cidade=cidade_sel)
 
 @app.route('/buscar_ruas_por_bairro')
 def buscar_ruas_por_bairro():
     bairro = request.args.get('bairro')
-    conn = open_conn()
-    if not conn:
-        return jsonify([]) # Retorna lista vazia se não houver conexão
-    
+    cidade = obter_cidade(request.args.get('cidade'))
+    if not cidade:
+        return jsonify([])
+
     ruas = []
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT DISTINCT RUA FROM LOCATIONS WHERE BAIRRO = %s ORDER BY RUA ASC", (bairro,))
-            ruas_data = cursor.fetchall()
-            ruas = [row['RUA'] for row in ruas_data]
+        ruas = listar_ruas(cidade['nome'], bairro) or [] # None = sem conexão: retorna lista vazia
     except pymysql.MySQLError as e:
-        app.logger.error(f"Erro ao buscar ruas para o bairro {bairro}: {e}")
-    finally:
-        if conn:
-            conn.close()
+        app.logger.error(f"Erro ao buscar ruas para o bairro {bairro} ({cidade['nome']}): {e}")
     return jsonify(ruas)
 
 
 # --- Funções e rota do Dashboard (adaptadas do seu exemplo) ---
-def gerar_dados_dashboard_pets():
-    conn = open_conn()
+def gerar_dados_dashboard_pets(cidade_nome):
+    conn = conexao_requisicao()
     if not conn: return None, None, None, None, True # sem_dados = True
 
     latest_cases, stats_chart, sem_dados = None, None, True
@@ -565,35 +1558,44 @@ def gerar_dados_dashboard_pets():
     try:
         with conn.cursor() as cursor:
             # Total de pets perdidos (não resolvidos)
-            cursor.execute("SELECT COUNT(*) as total FROM USERINPUT WHERE RESOLVIDO = 0 OR RESOLVIDO IS NULL")
+            cursor.execute("SELECT COUNT(*) as total FROM USERINPUT WHERE CIDADE = %s AND (RESOLVIDO = 0 OR RESOLVIDO IS NULL)", (cidade_nome,))
             total_perdidos = cursor.fetchone()['total']
 
-            # Total de pets encontrados (resolvidos)
-            cursor.execute("SELECT COUNT(*) as total FROM USERINPUT WHERE RESOLVIDO = 1")
-            total_encontrados = cursor.fetchone()['total']
+            # Total de pets encontrados (resolvidos), incluindo os já arquivados: soma das resoluções nos
+            # rollups diários, cujo custo não cresce com o histórico de casos (nem lê USERINPUT_ARQUIVO)
+            try:
+                cursor.execute("SELECT COALESCE(SUM(RESOLUCOES), 0) as total FROM STATS_DIARIAS WHERE CIDADE = %s", (cidade_nome,))
+                total_encontrados = int(cursor.fetchone()['total'])
+            except pymysql.err.ProgrammingError as e: # Banco ainda sem os rollups: só os casos ativos
+                app.logger.warning(f"Rollups indisponíveis para o total de encontrados: {e}")
+                cursor.execute("SELECT COUNT(*) as total FROM USERINPUT WHERE CIDADE = %s AND RESOLVIDO = 1", (cidade_nome,))
+                total_encontrados = cursor.fetchone()['total']
 
             # Top 5 bairros com mais pets perdidos
             cursor.execute("""
                 SELECT BAIRRO, COUNT(*) as count 
                 FROM USERINPUT 
-                WHERE (RESOLVIDO = 0 OR RESOLVIDO IS NULL) AND BAIRRO IS NOT NULL
+                WHERE CIDADE = %s AND (RESOLVIDO = 0 OR RESOLVIDO IS NULL) AND BAIRRO IS NOT NULL
                 GROUP BY BAIRRO 
                 ORDER BY count DESC 
                 LIMIT 5
-            """)
+            """, (cidade_nome,))
             top_bairros_perdidos = cursor.fetchall()
 
-            # Dados para WordCloud (usar nomes dos pets ou comentários)
-            cursor.execute("SELECT COMENTARIO FROM USERINPUT WHERE (RESOLVIDO = 0 OR RESOLVIDO IS NULL) AND COMENTARIO IS NOT NULL")
-            comentarios_data = cursor.fetchall()
+            # Nuvem de palavras: termos mais citados, lidos do índice incremental (sem trazer os comentários)
+            try:
+                termos_comentarios = top_termos_comentarios(cursor, cidade_nome, 30)
+            except pymysql.err.ProgrammingError as e: # Banco ainda sem a tabela TERMOS_COMENTARIOS
+                app.logger.warning(f"Índice de termos indisponível: {e}")
+                termos_comentarios = []
             
             # Últimos 5 casos cadastrados (não resolvidos)
             cursor.execute("""
                 SELECT NOME_PET, ESPECIE, BAIRRO, CREATED_AT 
                 FROM USERINPUT 
-                WHERE (RESOLVIDO = 0 OR RESOLVIDO IS NULL)
+                WHERE CIDADE = %s AND (RESOLVIDO = 0 OR RESOLVIDO IS NULL)
                 ORDER BY CREATED_AT DESC LIMIT 5
-            """)
+            """, (cidade_nome,))
             latest_cases = cursor.fetchall()
         
         # Gráfico de Estatísticas (Ex: Perdidos vs Encontrados)
@@ -619,60 +1621,513 @@ def gerar_dados_dashboard_pets():
             "total_encontrados": total_encontrados,
             "top_bairros_perdidos": top_bairros_perdidos,
             "latest_cases": latest_cases,
+            "termos_comentarios": termos_comentarios,
+            "max_termo": max([int(t['QTD']) for t in termos_comentarios], default=1),
             "stats_chart": stats_chart,
-            "sem_dados": sem_dados if not (total_perdidos > 0 or total_encontrados > 0 or comentarios_data) else False
+            "sem_dados": sem_dados if not (total_perdidos > 0 or total_encontrados > 0 or termos_comentarios) else False
         }
         return dashboard_data
 
     except pymysql.MySQLError as e:
         app.logger.error(f"Erro ao gerar dados do dashboard: {e}")
         return {"sem_dados": True} # Retorna um dict indicando erro/sem dados
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/dashboard')
 def dashboard():
-    data = gerar_dados_dashboard_pets()
+    cidade = obter_cidade(request.args.get('cidade'))
+    if not cidade:
+        return cidade_nao_encontrada('dashboard', request.args.get('cidade'))
+
+    data = gerar_dados_dashboard_pets(cidade['nome'])
     if not data: # Se gerar_dados_dashboard_pets falhar na conexão
         flash("Erro ao carregar dados para o dashboard.", "danger")
         data = {"sem_dados": True} # Garante que 'data' é um dict
 
-    return render_template('dashboard.html', data=data, current_year=datetime.now().year)
+    return render_template('dashboard.html', data=data, cidade=cidade, current_year=datetime.now().year)
 
 
-@app.route('/confirmar_encerrar_busca/<int:pet_id>')
-def confirmar_encerrar_busca(pet_id):
-    conn = open_conn()
+# --- Rollups diários (séries temporais por cidade/bairro/espécie) ---
+# As tabelas STATS_DIARIAS e STATS_TEMPO_RESOLUCAO são atualizadas na mesma transação
+# das rotas de escrita, e podem ser reconstruídas com others/backfill_stats.py.
+def faixa_tempo_resolucao(horas):
+    """Retorna o índice da faixa do histograma para um tempo de resolução em horas."""
+    return bisect_right(FAIXAS_TEMPO_RESOLUCAO_HORAS, max(horas, 0))
+
+
+ER_NO_SUCH_TABLE = 1146
+
+
+@contextmanager
+def escrita_opcional(cursor, savepoint):
+    """Escritas em tabelas derivadas (rollups, índice de termos) dentro da transação de uma rota.
+
+    Se a tabela ainda não existe no banco, as escritas do bloco são desfeitas até o SAVEPOINT e
+    ignoradas: o cadastro/resolução segue, como as leituras, que já tratam essas tabelas como
+    opcionais. Outros erros continuam abortando a transação.
+    """
+    cursor.execute(f"SAVEPOINT {savepoint}")
+    try:
+        yield
+    except pymysql.err.ProgrammingError as e:
+        if e.args[0] != ER_NO_SUCH_TABLE:
+            raise
+        cursor.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+        app.logger.warning(f"Tabela derivada ausente, escrita ignorada ({savepoint}): {e}")
+    else:
+        cursor.execute(f"RELEASE SAVEPOINT {savepoint}")
+
+
+def registrar_novo_caso_stats(cursor, created_at, cidade, bairro, especie):
+    """Incrementa o contador de novos casos do dia no rollup (não faz commit)."""
+    with escrita_opcional(cursor, 'rollups'):
+        cursor.execute("""
+            INSERT INTO STATS_DIARIAS (CIDADE, DIA, BAIRRO, ESPECIE, NOVOS_CASOS, RESOLUCOES)
+            VALUES (%s, %s, %s, %s, 1, 0)
+            ON DUPLICATE KEY UPDATE NOVOS_CASOS = NOVOS_CASOS + 1
+        """, (cidade, created_at.date(), bairro or '', especie or ''))
+
+
+def registrar_resolucao_stats(cursor, pet_id, resolvido_at, pet=None):
+    """Contabiliza a resolução do pet no rollup do dia e no histograma de tempo (não faz commit).
+
+    Também retira o comentário do caso do índice de termos, que só considera casos abertos.
+    Se a rota já leu CIDADE, BAIRRO, ESPECIE, CREATED_AT e COMENTARIO do pet, pode passá-los em `pet`
+    e evitar o SELECT. Retorna os dados do pet usados ou None se não existir.
+    """
+    if pet is None:
+        cursor.execute("SELECT CIDADE, BAIRRO, ESPECIE, CREATED_AT, COMENTARIO FROM USERINPUT WHERE ID = %s", (pet_id,))
+        pet = cursor.fetchone()
+    if not pet:
+        return None
+    cidade, bairro, especie = pet['CIDADE'], pet.get('BAIRRO') or '', pet.get('ESPECIE') or ''
+    dia = resolvido_at.date()
+    with escrita_opcional(cursor, 'rollups'): # As duas tabelas mudam juntas ou nenhuma
+        cursor.execute("""
+            INSERT INTO STATS_DIARIAS (CIDADE, DIA, BAIRRO, ESPECIE, NOVOS_CASOS, RESOLUCOES)
+            VALUES (%s, %s, %s, %s, 0, 1)
+            ON DUPLICATE KEY UPDATE RESOLUCOES = RESOLUCOES + 1
+        """, (cidade, dia, bairro, especie))
+        if pet.get('CREATED_AT'):
+            horas = (resolvido_at - pet['CREATED_AT']).total_seconds() / 3600
+            cursor.execute("""
+                INSERT INTO STATS_TEMPO_RESOLUCAO (CIDADE, DIA, BAIRRO, ESPECIE, FAIXA, QTD)
+                VALUES (%s, %s, %s, %s, %s, 1)
+                ON DUPLICATE KEY UPDATE QTD = QTD + 1
+            """, (cidade, dia, bairro, especie, faixa_tempo_resolucao(horas)))
+    atualizar_termos_comentario(cursor, cidade, pet.get('COMENTARIO'), -1)
+    return pet
+
+
+def estimar_mediana_horas(contagem_por_faixa):
+    """Estima a mediana (em horas) interpolando dentro da faixa do histograma que contém o ponto central."""
+    total = sum(contagem_por_faixa.values())
+    if not total:
+        return None
+    metade = total / 2
+    acumulado = 0
+    for faixa in sorted(contagem_por_faixa):
+        qtd = contagem_por_faixa[faixa]
+        if qtd and acumulado + qtd >= metade:
+            inicio = FAIXAS_TEMPO_RESOLUCAO_HORAS[faixa - 1] if faixa > 0 else 0
+            if faixa >= len(FAIXAS_TEMPO_RESOLUCAO_HORAS): # Faixa aberta: usa o limite inferior
+                return float(inicio)
+            fim = FAIXAS_TEMPO_RESOLUCAO_HORAS[faixa]
+            return round(inicio + (fim - inicio) * (metade - acumulado) / qtd, 1)
+        acumulado += qtd
+    return None
+
+
+# --- Índice de termos dos comentários dos casos abertos (TERMOS_COMENTARIOS) ---
+# QTD é o número de casos abertos da cidade cujo comentário contém o termo. Atualizado na mesma
+# transação do cadastro (+1) e da resolução (-1); reconstrução completa com others/backfill_stats.py.
+# As stopwords já estão sem acentos, como os termos depois de normalizados.
+STOPWORDS_PT = frozenset("""
+    a ao aos as ate com como da das de dela dele deles do dos e ela elas ele eles em entre era essa esse
+    esta estava este eu foi ha isso isto ja la lhe mais mas me mesmo meu minha muito na nao nas nem no
+    nos nossa nosso num numa o os ou para pela pelas pelo pelos perto por pra qual quando que quem se
+    sem ser seu sua tambem tem tinha todo toda um uma umas uns voce estao sao bem bastante pouco
+    muita muitos muitas tipo onde aqui ali dia dias hoje ontem fica ficou estar sendo tenho temos
+    """.split())
+
+
+def normalizar_texto(texto):
+    """Minúsculas e sem acentos ('Não é Pássaro' -> 'nao e passaro')."""
+    return unicodedata.normalize('NFKD', texto.casefold()).encode('ascii', 'ignore').decode('ascii')
+
+
+def tokenizar_comentario(texto):
+    """Conjunto de termos do comentário: normalizados, sem stopwords, números ou palavras muito curtas."""
+    if not texto:
+        return set()
+    return {termo[:TERMO_MAX_CARACTERES] for termo in re.findall(r'[a-z]+', normalizar_texto(texto))
+            if len(termo) >= TERMO_MIN_CARACTERES and termo not in STOPWORDS_PT}
+
+
+def atualizar_termos_comentario(cursor, cidade, comentario, delta):
+    """Soma `delta` (+1 no cadastro, -1 na resolução) a cada termo do comentário (não faz commit)."""
+    termos = sorted(tokenizar_comentario(comentario))
+    if not termos:
+        return
+    with escrita_opcional(cursor, 'termos'):
+        # executemany junta as linhas em um único INSERT multi-valores
+        cursor.executemany("""
+            INSERT INTO TERMOS_COMENTARIOS (CIDADE, TERMO, QTD) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE QTD = QTD + VALUES(QTD)
+        """, [(cidade, termo, delta) for termo in termos])
+        if delta < 0:
+            marcadores = ', '.join(['%s'] * len(termos))
+            cursor.execute(f"DELETE FROM TERMOS_COMENTARIOS WHERE CIDADE = %s AND TERMO IN ({marcadores}) AND QTD <= 0",
+                           [cidade] + termos)
+
+
+def top_termos_comentarios(cursor, cidade_nome, limite):
+    cursor.execute("""
+        SELECT TERMO, QTD FROM TERMOS_COMENTARIOS
+        WHERE CIDADE = %s AND QTD > 0
+        ORDER BY QTD DESC, TERMO ASC LIMIT %s
+    """, (cidade_nome, limite))
+    return cursor.fetchall()
+
+
+@app.route('/api/stats/termos')
+def stats_termos():
+    # Parâmetros: cidade (slug ou nome, padrão CIDADE_PADRAO) e limite (1 a 200, padrão 50)
+    cidade = obter_cidade(request.args.get('cidade'))
+    if not cidade:
+        return jsonify({"success": False, "message": "Cidade não encontrada."}), 404
+    try:
+        limite = int(request.args.get('limite', 50))
+    except ValueError:
+        return jsonify({"success": False, "message": "Limite deve ser um número inteiro."}), 400
+    limite = min(max(limite, 1), 200)
+
+    conn = conexao_requisicao()
     if not conn:
-        flash("Erro de conexão com o banco.", "danger")
-        return redirect(url_for('detalhes_pet', pet_id=pet_id)) # Redireciona para detalhes em caso de erro de conexão
+        return jsonify({"success": False, "message": "Erro de conexão com o banco."}), 503
+    try:
+        with conn.cursor() as cursor:
+            termos = top_termos_comentarios(cursor, cidade['nome'], limite)
+    except pymysql.MySQLError as e:
+        app.logger.error(f"Erro ao buscar termos dos comentários: {e}")
+        return jsonify({"success": False, "message": "Erro ao consultar o banco de dados."}), 500
 
-    pet_file_paths = None
+    return jsonify({
+        "success": True,
+        "cidade": cidade['nome'],
+        "termos": [{"termo": row['TERMO'], "qtd": int(row['QTD'])} for row in termos],
+    })
+
+
+@app.route('/api/stats/timeseries')
+def stats_timeseries():
+    # Parâmetros: cidade (slug ou nome, padrão CIDADE_PADRAO), inicio/fim (AAAA-MM-DD, padrão
+    # últimos 30 dias), bairro, especie e agrupar ('bairro' ou 'especie') para uma série por grupo.
+    try:
+        fim = datetime.strptime(request.args['fim'], '%Y-%m-%d').date() if request.args.get('fim') else datetime.now().date()
+        inicio = datetime.strptime(request.args['inicio'], '%Y-%m-%d').date() if request.args.get('inicio') else fim - timedelta(days=29)
+    except ValueError:
+        return jsonify({"success": False, "message": "Datas devem estar no formato AAAA-MM-DD."}), 400
+    if inicio > fim:
+        return jsonify({"success": False, "message": "A data inicial deve ser anterior à final."}), 400
+    cidade = obter_cidade(request.args.get('cidade'))
+    if not cidade:
+        return jsonify({"success": False, "message": "Cidade não encontrada."}), 404
+
+    colunas_agrupamento = {'bairro': 'BAIRRO', 'especie': 'ESPECIE'}
+    agrupar = request.args.get('agrupar')
+    if agrupar and agrupar not in colunas_agrupamento:
+        return jsonify({"success": False, "message": "Agrupamento inválido (use 'bairro' ou 'especie')."}), 400
+    coluna_grupo = colunas_agrupamento.get(agrupar)
+
+    filtros, params = ["CIDADE = %s", "DIA BETWEEN %s AND %s"], [cidade['nome'], inicio, fim]
+    for parametro, coluna in colunas_agrupamento.items():
+        if request.args.get(parametro):
+            filtros.append(f"{coluna} = %s")
+            params.append(request.args.get(parametro))
+    where = " AND ".join(filtros)
+    select_grupo = f"{coluna_grupo} AS GRUPO" if coluna_grupo else "NULL AS GRUPO"
+    group_by = f"DIA, {coluna_grupo}" if coluna_grupo else "DIA"
+
+    conn = conexao_requisicao()
+    if not conn:
+        return jsonify({"success": False, "message": "Erro de conexão com o banco."}), 503
     try:
-        with conn.cursor() as cursor_select:
-            # Buscamos FOTO_PATH e THUMBNAIL_PATH para deletar do S3
-            cursor_select.execute("SELECT FOTO_PATH, THUMBNAIL_PATH FROM USERINPUT WHERE ID = %s", (pet_id,))
-            pet_file_paths = cursor_select.fetchone()
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT DIA, {select_grupo}, SUM(NOVOS_CASOS) AS NOVOS_CASOS, SUM(RESOLUCOES) AS RESOLUCOES
+                FROM STATS_DIARIAS
+                WHERE {where}
+                GROUP BY {group_by}
+                ORDER BY DIA
+            """, params)
+            diarios = cursor.fetchall()
+            cursor.execute(f"""
+                SELECT DIA, {select_grupo}, FAIXA, SUM(QTD) AS QTD
+                FROM STATS_TEMPO_RESOLUCAO
+                WHERE {where}
+                GROUP BY {group_by}, FAIXA
+            """, params)
+            faixas = cursor.fetchall()
     except pymysql.MySQLError as e:
-        app.logger.error(f"Erro ao buscar caminhos de arquivo para o pet ID {pet_id} antes de deletar: {e}")
-        flash("Erro ao preparar para encerrar busca (não foi possível ler caminhos dos arquivos).", "danger")
-        if conn: conn.close()
-        return redirect(url_for('detalhes_pet', pet_id=pet_id))
+        app.logger.error(f"Erro ao buscar séries temporais: {e}")
+        return jsonify({"success": False, "message": "Erro ao consultar o banco de dados."}), 500
+
+    # Histogramas por (grupo, dia) e acumulados por grupo para a mediana do período
+    histograma_dia, histograma_periodo = {}, {}
+    for row in faixas:
+        qtd = int(row['QTD'])
+        dia_hist = histograma_dia.setdefault((row['GRUPO'], row['DIA']), {})
+        dia_hist[row['FAIXA']] = dia_hist.get(row['FAIXA'], 0) + qtd
+        periodo_hist = histograma_periodo.setdefault(row['GRUPO'], {})
+        periodo_hist[row['FAIXA']] = periodo_hist.get(row['FAIXA'], 0) + qtd
+
+    series = {}
+    for row in diarios:
+        serie = series.setdefault(row['GRUPO'], {
+            "grupo": row['GRUPO'],
+            "pontos": [],
+            "totais": {"novos_casos": 0, "resolucoes": 0},
+        })
+        novos, resolucoes = int(row['NOVOS_CASOS']), int(row['RESOLUCOES'])
+        serie["pontos"].append({
+            "dia": row['DIA'].isoformat(),
+            "novos_casos": novos,
+            "resolucoes": resolucoes,
+            "mediana_horas_resolucao": estimar_mediana_horas(histograma_dia.get((row['GRUPO'], row['DIA']), {})),
+        })
+        serie["totais"]["novos_casos"] += novos
+        serie["totais"]["resolucoes"] += resolucoes
+    for grupo, serie in series.items():
+        serie["totais"]["mediana_horas_resolucao"] = estimar_mediana_horas(histograma_periodo.get(grupo, {}))
+
+    return jsonify({
+        "success": True,
+        "cidade": cidade['nome'],
+        "inicio": inicio.isoformat(),
+        "fim": fim.isoformat(),
+        "agrupar": agrupar,
+        "series": list(series.values()),
+    })
+
+
+# --- Exportação de casos para análise (CSV e GeoJSON em streaming) ---
+# Contato e caminhos das fotos ficam de fora: a exportação é para análise, não para contato com tutores.
+COLUNAS_EXPORTACAO = ['ID', 'NOME_PET', 'ESPECIE', 'STATUS_PET', 'RUA', 'BAIRRO', 'CIDADE', 'COMENTARIO',
+                      'CREATED_AT', 'RESOLVIDO', 'RESOLVIDO_AT', 'LATITUDE', 'LONGITUDE']
+STATUS_EXPORTACAO = {'perdi': 'Perdi meu PET', 'encontrei': 'Encontrei um PET'}
+
+
+def filtros_exportacao():
+    """Monta (cidade, where, params) a partir da query string, ou levanta ValueError com a mensagem para o usuário.
+
+    Parâmetros: cidade (slug ou nome), status ('perdi' ou 'encontrei'), resolvido (0 ou 1),
+    inicio/fim (AAAA-MM-DD, sobre CREATED_AT) e bairro.
+    """
+    cidade = obter_cidade(request.args.get('cidade'))
+    if not cidade:
+        raise ValueError("Cidade não encontrada.")
+    filtros, params = ["CIDADE = %s"], [cidade['nome']]
+
+    status = request.args.get('status')
+    if status:
+        if status.lower() not in STATUS_EXPORTACAO:
+            raise ValueError("Status inválido (use 'perdi' ou 'encontrei').")
+        filtros.append("STATUS_PET = %s")
+        params.append(STATUS_EXPORTACAO[status.lower()])
+
+    resolvido = request.args.get('resolvido')
+    if resolvido == '1':
+        filtros.append("RESOLVIDO = 1")
+    elif resolvido == '0':
+        filtros.append("(RESOLVIDO = 0 OR RESOLVIDO IS NULL)")
+    elif resolvido:
+        raise ValueError("Parâmetro resolvido deve ser 0 ou 1.")
+
+    try:
+        inicio = datetime.strptime(request.args['inicio'], '%Y-%m-%d') if request.args.get('inicio') else None
+        fim = datetime.strptime(request.args['fim'], '%Y-%m-%d') if request.args.get('fim') else None
+    except ValueError:
+        raise ValueError("Datas devem estar no formato AAAA-MM-DD.")
+    if inicio and fim and inicio > fim:
+        raise ValueError("A data inicial deve ser anterior à final.")
+    if inicio:
+        filtros.append("CREATED_AT >= %s")
+        params.append(inicio)
+    if fim: # Dia final inteiro
+        filtros.append("CREATED_AT < %s")
+        params.append(fim + timedelta(days=1))
+
+    if request.args.get('bairro'):
+        filtros.append("BAIRRO = %s")
+        params.append(request.args.get('bairro'))
+    return cidade, " AND ".join(filtros), params
+
+
+def linhas_exportacao(conn, where, params):
+    """Gera as linhas (tuplas na ordem de COLUNAS_EXPORTACAO) de um cursor do servidor, sem carregar tudo na memória.
+
+    Percorre USERINPUT e depois o arquivo de casos resolvidos, em duas consultas (um UNION com ORDER BY
+    obrigaria o MySQL a materializar o resultado antes de enviar a primeira linha).
+    """
+    for tabela in ('USERINPUT', 'USERINPUT_ARQUIVO'):
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        try:
+            try:
+                cursor.execute(f"SELECT {', '.join(COLUNAS_EXPORTACAO)} FROM {tabela} WHERE {where} ORDER BY ID", params)
+            except pymysql.err.ProgrammingError as e:
+                if tabela == 'USERINPUT':
+                    raise
+                app.logger.warning(f"Tabelas de arquivo indisponíveis: {e}")
+                cursor.close()
+                continue
+            while True:
+                lote = cursor.fetchmany(EXPORT_LOTE_LINHAS)
+                if not lote:
+                    break
+                yield from lote
+            cursor.close() # Resultado já lido por inteiro: fechar é barato
+        except (GeneratorExit, pymysql.MySQLError):
+            # Cliente desistiu no meio ou o banco falhou. SSCursor.close() leria o resto do resultado
+            # até o fim; fechar a conexão é o que o descarta de fato.
+            fechar_conexao(conn)
+            raise
+
+
+def fechar_conexao(conn):
+    if conn.open:
+        conn.close()
+
+
+def valor_exportacao(valor):
+    if isinstance(valor, datetime):
+        return valor.isoformat(sep=' ')
+    return float(valor) if isinstance(valor, Decimal) else valor # Coordenadas vêm como Decimal
+
+
+def iniciar_exportacao(formato):
+    """Validações comuns às duas exportações. Retorna (conn, cidade, where, params) ou uma resposta de erro."""
+    espera = consumir_token('exportar', identificar_cliente(), capacidade=3, por_minuto=6)
+    if espera:
+        return rejeitar_escrita("Muitas exportações em pouco tempo. Aguarde alguns instantes e tente novamente.",
+                                429, True, retry_after=espera)
+    try:
+        cidade, where, params = filtros_exportacao()
+    except ValueError as e:
+        return make_response(jsonify({"success": False, "message": str(e)}), 400)
+    # Conexão própria, fora de flask.g: o teardown da requisição roda antes do streaming terminar
+    conn = open_conn()
+    if not conn:
+        return make_response(jsonify({"success": False, "message": "Erro de conexão com o banco."}), 503)
+    app.logger.info(f"Exportação {formato} de {cidade['nome']} iniciada (cliente {identificar_cliente()}).")
+    return conn, cidade, where, params
 
-    if not pet_file_paths:
-        flash("Pet não encontrado para buscar caminhos de arquivo.", "warning")
-        if conn: conn.close()
-        return redirect(url_for('principal')) # Pet não existe, volta para principal
 
+def resposta_exportacao(conn, gerador, mimetype, cidade, extensao):
+    resposta = app.response_class(gerador, mimetype=mimetype)
+    resposta.call_on_close(lambda: fechar_conexao(conn)) # Ao fim do envio (ou já fechada se interrompido)
+    nome_arquivo = f"pets_{cidade['slug']}_{datetime.now().strftime('%Y%m%d')}.{extensao}"
+    resposta.headers['Content-Disposition'] = f'attachment; filename="{nome_arquivo}"'
+    resposta.headers['X-Accel-Buffering'] = 'no' # Não deixar proxies acumularem a resposta inteira
+    return resposta
+
+
+class _EcoCSV:
+    """Arquivo falso para o csv.writer: writerow devolve a linha formatada em vez de gravar."""
+    def write(self, valor):
+        return valor
+
+
+@app.route('/api/export/pets.csv')
+def exportar_pets_csv():
+    inicio = iniciar_exportacao('CSV')
+    if not isinstance(inicio, tuple):
+        return inicio
+    conn, cidade, where, params = inicio
+
+    def gerar():
+        escritor = csv.writer(_EcoCSV())
+        yield escritor.writerow(COLUNAS_EXPORTACAO)
+        pedaco = []
+        try:
+            for linha in linhas_exportacao(conn, where, params):
+                pedaco.append(escritor.writerow([valor_exportacao(v) for v in linha]))
+                if len(pedaco) >= EXPORT_LOTE_LINHAS:
+                    yield ''.join(pedaco)
+                    pedaco = []
+        except pymysql.MySQLError as e:
+            # Cabeçalhos (200) já enviados: relançar interrompe a transferência, e o cliente não
+            # recebe um arquivo truncado que pareça completo
+            app.logger.error(f"Exportação CSV interrompida: {e}")
+            raise
+        yield ''.join(pedaco)
+
+    return resposta_exportacao(conn, gerar(), 'text/csv; charset=utf-8', cidade, 'csv')
+
+
+@app.route('/api/export/pets.geojson')
+def exportar_pets_geojson():
+    inicio = iniciar_exportacao('GeoJSON')
+    if not isinstance(inicio, tuple):
+        return inicio
+    conn, cidade, where, params = inicio
+    i_lat, i_lon = COLUNAS_EXPORTACAO.index('LATITUDE'), COLUNAS_EXPORTACAO.index('LONGITUDE')
+
+    def gerar():
+        yield '{"type": "FeatureCollection", "features": [\n'
+        separador, pedaco = '', []
+        try:
+            for linha in linhas_exportacao(conn, where, params):
+                valores = [valor_exportacao(v) for v in linha]
+                geometria = None # Casos sem coordenadas continuam no arquivo, sem geometria
+                if valores[i_lat] is not None and valores[i_lon] is not None:
+                    geometria = {"type": "Point", "coordinates": [valores[i_lon], valores[i_lat]]}
+                propriedades = {coluna: valor for coluna, valor in zip(COLUNAS_EXPORTACAO, valores)
+                                if coluna not in ('LATITUDE', 'LONGITUDE')}
+                pedaco.append(separador + json.dumps({"type": "Feature", "geometry": geometria,
+                                                      "properties": propriedades}, ensure_ascii=False))
+                separador = ',\n'
+                if len(pedaco) >= EXPORT_LOTE_LINHAS:
+                    yield ''.join(pedaco)
+                    pedaco = []
+        except pymysql.MySQLError as e:
+            app.logger.error(f"Exportação GeoJSON interrompida: {e}")
+            raise # Sem o fechamento ']}': o arquivo fica inválido em vez de parecer completo
+        yield ''.join(pedaco) + '\n]}\n'
+
+    return resposta_exportacao(conn, gerar(), 'application/geo+json', cidade, 'geojson')
+
+
+@app.route('/confirmar_encerrar_busca/<int:pet_id>', methods=['POST'])
+@protecao_escrita(capacidade=3, por_minuto=6) # Escrita mais cara: UPDATE, atlas (download + 2 PUTs) e deleções no S3
+def confirmar_encerrar_busca(pet_id):
+    conn = conexao_requisicao()
+    if not conn:
+        flash("Erro de conexão com o banco.", "danger")
+        return redirect(url_for('detalhes_pet', pet_id=pet_id)) # Redireciona para detalhes em caso de erro de conexão
+
+    cidade_pet = None
     try:
-        with conn.cursor() as cursor_update:
+        with transacao(conn) as cursor:
+            # Buscamos FOTO_PATH e THUMBNAIL_PATH para deletar do S3, junto com os campos usados pelo rollup
+            cursor.execute("""
+                SELECT FOTO_PATH, THUMBNAIL_PATH, CIDADE, BAIRRO, ESPECIE, CREATED_AT, COMENTARIO
+                FROM USERINPUT WHERE ID = %s
+            """, (pet_id,))
+            pet_file_paths = cursor.fetchone()
+            if not pet_file_paths:
+                flash("Pet não encontrado para buscar caminhos de arquivo.", "warning")
+                return redirect(url_for('principal')) # Pet não existe, volta para principal
+            cidade_pet = pet_file_paths['CIDADE']
+
+            resolvido_at = datetime.now()
             sql_update = "UPDATE USERINPUT SET RESOLVIDO = 1, RESOLVIDO_AT = %s WHERE ID = %s AND (RESOLVIDO = 0 OR RESOLVIDO IS NULL)"
-            affected_rows = cursor_update.execute(sql_update, (datetime.now(), pet_id))
-            conn.commit()
+            affected_rows = cursor.execute(sql_update, (resolvido_at, pet_id))
+            if affected_rows > 0:
+                registrar_resolucao_stats(cursor, pet_id, resolvido_at, pet=pet_file_paths)
 
         if affected_rows > 0:
             flash("Busca encerrada com sucesso no banco de dados!", "success")
+            remover_do_atlas(pet_id, pet_file_paths['CIDADE'])
             
             app.logger.info(f"Tentando deletar arquivos S3 para o pet ID {pet_id}...")
             s3_foto_key = pet_file_paths.get('FOTO_PATH')
@@ -693,27 +2148,17 @@ def confirmar_encerrar_busca(pet_id):
     except pymysql.MySQLError as e_db_update:
         app.logger.error(f"Erro de banco de dados ao encerrar busca para pet ID {pet_id}: {e_db_update}")
         flash("Erro ao atualizar o status do pet no banco de dados.", "danger")
-        if conn: conn.rollback()
     except Exception as e_main_logic:
         app.logger.error(f"Erro inesperado na lógica de encerrar busca para pet ID {pet_id}: {e_main_logic}")
         flash("Ocorreu um erro inesperado ao processar sua solicitação.", "danger")
-        if conn and conn.open: conn.rollback()
-    finally:
-        if conn:
-            conn.close()
             
-    # Sempre redireciona para a página de detalhes do pet após a tentativa de encerrar
-    # assim o usuário vê o status atualizado (ou a mensagem de erro se a busca já estava encerrada)
-    return redirect(url_for('principal'))
+    # Volta para o mapa da cidade do pet, onde o caso encerrado deixa de aparecer
+    return redirect(url_for('principal', cidade_slug=slug_cidade(cidade_pet) if cidade_pet else None))
 
 
 @app.route('/pet/<int:pet_id>/add_message', methods=['POST'])
+@protecao_escrita(capacidade=5, por_minuto=10)
 def add_message(pet_id):
-    conn = open_conn()
-    if not conn:
-        flash("Erro de conexão com o banco de dados ao tentar postar mensagem.", "danger")
-        return redirect(url_for('detalhes_pet', pet_id=pet_id))
-
     commenter_name = request.form.get('commenter_name', 'Anônimo') # Pega o nome ou default 'Anônimo'
     message_text = request.form.get('message_text')
 
@@ -725,27 +2170,105 @@ def add_message(pet_id):
         flash("A mensagem é muito longa (máximo de 200 caracteres).", "warning")
         return redirect(url_for('detalhes_pet', pet_id=pet_id))
 
+    # A conexão só é aberta depois das validações: mensagens inválidas não custam acesso ao banco
+    conn = conexao_requisicao()
+    if not conn:
+        flash("Erro de conexão com o banco de dados ao tentar postar mensagem.", "danger")
+        return redirect(url_for('detalhes_pet', pet_id=pet_id))
+
     try:
-        with conn.cursor() as cursor:
-            # Verificar se o PetID existe antes de inserir a mensagem
-            cursor.execute("SELECT ID FROM USERINPUT WHERE ID = %s", (pet_id,))
-            if not cursor.fetchone():
-                flash("PET não encontrado para adicionar mensagem.", "danger")
-                return redirect(url_for('principal'))
-
-            sql = "INSERT INTO MESSAGES (PetID, CommenterName, MessageText) VALUES (%s, %s, %s)"
-            cursor.execute(sql, (pet_id, commenter_name.strip(), message_text.strip()))
-            conn.commit()
-            flash("Mensagem enviada com sucesso!", "success")
+        with transacao(conn) as cursor:
+            # Insere só se o PetID existir, na mesma ida ao banco (antes: SELECT e depois INSERT)
+            sql = """
+                INSERT INTO MESSAGES (PetID, CommenterName, MessageText)
+                SELECT ID, %s, %s FROM USERINPUT WHERE ID = %s
+            """
+            inseridas = cursor.execute(sql, (commenter_name.strip(), message_text.strip(), pet_id))
+        if not inseridas:
+            flash("PET não encontrado para adicionar mensagem.", "danger")
+            return redirect(url_for('principal'))
+        flash("Mensagem enviada com sucesso!", "success")
     except pymysql.MySQLError as e:
         app.logger.error(f"Erro ao salvar mensagem para o pet ID {pet_id}: {e}")
         flash("Erro ao enviar mensagem.", "danger")
-        conn.rollback() # Desfaz a transação em caso de erro
-    finally:
-        if conn:
-            conn.close()
     
     return redirect(url_for('detalhes_pet', pet_id=pet_id))
 
+# --- Fábrica da aplicação e estado por processo (vários workers: ver gunicorn.conf.py) ---
+def chave_secreta():
+    """SECRET_KEY do ambiente, igual em todos os workers e reinícios.
+
+    Obrigatória quando EXIGIR_SECRET_KEY=1 (gunicorn.conf.py): sem ela o app não sobe. Fora disso
+    (desenvolvimento local), uma chave aleatória; com preload_app seria gerada uma vez no master.
+    """
+    chave = os.getenv('SECRET_KEY')
+    if chave:
+        return chave
+    if os.getenv('EXIGIR_SECRET_KEY') == '1':
+        raise RuntimeError("SECRET_KEY não definida. Defina uma chave aleatória longa (ex: python -c "
+                           "\"import secrets; print(secrets.token_urlsafe(32))\") antes de iniciar o servidor.")
+    app.logger.warning("SECRET_KEY não definida: usando chave aleatória (sessões não sobrevivem a reinícios).")
+    return secrets.token_urlsafe(32)
+
+
+def carregar_configuracao():
+    return {
+        'SECRET_KEY': chave_secreta(),
+        'MAX_CONTENT_LENGTH': MAX_UPLOAD_BYTES,
+        'AQUECER_CACHES': os.getenv('AQUECER_CACHES', '0') == '1', # gunicorn.conf.py liga por padrão
+    }
+
+
+def aquecer_caches():
+    """Confere o snapshot do gazetteer e pré-carrega cidades, bairros e manifestos do sprite atlas.
+
+    Com preload_app, roda uma vez no master e os workers herdam os caches já preenchidos.
+    """
+    inicio = time.monotonic()
+    verificar_gazetteer()
+    cidades = carregar_cidades()
+    for cidade in cidades.values():
+        try:
+            listar_bairros(cidade['nome'])
+        except pymysql.MySQLError as e:
+            app.logger.warning(f"Aquecimento: bairros de {cidade['nome']} indisponíveis: {e}")
+        carregar_manifesto_sprites(cidade['nome'])
+    app.logger.info(f"Caches aquecidos para {len(cidades)} cidade(s) em {time.monotonic() - inicio:.2f}s.")
+
+
+def reiniciar_estado_do_processo():
+    """Roda no processo filho logo após um fork (workers do gunicorn).
+
+    Locks podem ter sido copiados no meio de um uso e o cliente boto3 guarda conexões HTTP do pai;
+    caches (cidades, localidades, manifestos) e o mmap do gazetteer podem ser herdados como estão.
+    """
+    global _localidades_lock, _sprites_lock, _idempotencia_lock, _buckets_lock
+    _localidades_lock = threading.Lock()
+    _sprites_lock = threading.Lock()
+    _idempotencia_lock = threading.Lock()
+    _buckets_lock = threading.Lock()
+    init_s3()
+
+
+_fork_registrado = False
+
+
+def create_app(config=None):
+    """Configura a aplicação a partir do ambiente (e de `config`, para sobrescrever) e a devolve."""
+    global _fork_registrado
+    app.config.update(carregar_configuracao())
+    if config:
+        app.config.update(config)
+    init_s3()
+    if not _fork_registrado and hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=reiniciar_estado_do_processo)
+        _fork_registrado = True
+    if app.config['AQUECER_CACHES']:
+        aquecer_caches()
+    return app
+
+
+create_app()
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
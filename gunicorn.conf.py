@@ -0,0 +1,38 @@
+import os
+import multiprocessing
+
+# Execução em servidor próprio com vários processos (na Vercel o app roda como função
+# serverless e este arquivo não é usado). Na raiz do repositório:
+#   gunicorn -c gunicorn.conf.py
+# Variáveis: PORT, WEB_CONCURRENCY (nº de workers), SECRET_KEY (obrigatória), AQUECER_CACHES,
+# PROXY_FIX_X_FOR (nº de proxies reversos na frente; 0 = X-Forwarded-For ignorado).
+
+chdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api')
+wsgi_app = 'app:app'
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# Workers síncronos: o dashboard usa matplotlib.pyplot, que não é thread-safe. As rotas passam boa
+# parte do tempo esperando MySQL/S3, por isso mais de um worker por núcleo (recomendação do gunicorn).
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'sync'
+timeout = 60
+graceful_timeout = 30
+
+# Importa o app uma vez no master: create_app() aquece os caches antes do fork e os workers
+# os herdam (copy-on-write), assim como as páginas do snapshot do gazetteer. O estado que não
+# pode ser herdado (cliente S3, locks) é recriado em cada worker por reiniciar_estado_do_processo.
+preload_app = True
+os.environ.setdefault('AQUECER_CACHES', '1')
+# Sessões e mensagens flash são assinadas com SECRET_KEY: sem ela o app se recusa a iniciar
+os.environ.setdefault('EXIGIR_SECRET_KEY', '1')
+
+# Recicla workers periodicamente (PIL/matplotlib fragmentam a memória ao longo do tempo)
+max_requests = 1000
+max_requests_jitter = 100
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    server.log.info(f"Worker {worker.pid} iniciado (cliente S3 e locks recriados após o fork).")
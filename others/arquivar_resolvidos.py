@@ -0,0 +1,124 @@
+import os
+import sys
+from datetime import datetime, timedelta
+import pymysql
+from dotenv import load_dotenv
+
+# Move os casos resolvidos há mais de ARQUIVAR_APOS_DIAS de USERINPUT para USERINPUT_ARQUIVO
+# (particionada por mês de RESOLVIDO_AT), junto com as mensagens, para manter a tabela quente
+# e seus índices pequenos. Ver o DDL em documentation_app.txt.
+# Uso: python arquivar_resolvidos.py [dias]
+#
+# Os rollups (STATS_DIARIAS/STATS_TEMPO_RESOLUCAO) não mudam: os casos já foram contabilizados
+# quando foram cadastrados e resolvidos, e o backfill_stats.py também lê o arquivo.
+
+load_dotenv()
+
+DB_HOST = os.getenv('MYSQL_HOST')
+DB_USER = os.getenv('MYSQL_USER')
+DB_PASSWORD = os.getenv('MYSQL_PASSWORD')
+DB_NAME = os.getenv('MYSQL_DB')
+DB_PORT = int(os.getenv('MYSQL_PORT', 3306))
+
+ARQUIVAR_APOS_DIAS = int(os.getenv('ARQUIVAR_APOS_DIAS', 90))
+LOTE = 500 # Casos movidos por transação (transações curtas seguram poucos locks)
+
+COLUNAS_CASO = ("ID, NOME_PET, ESPECIE, RUA, BAIRRO, CIDADE, CONTATO, COMENTARIO, FOTO_PATH, THUMBNAIL_PATH, "
+                "CREATED_AT, RESOLVIDO, RESOLVIDO_AT, LATITUDE, LONGITUDE, STATUS_PET")
+COLUNAS_MENSAGEM = "MessageID, PetID, CommenterName, MessageText, CreatedAt"
+
+
+def create_db_connection():
+    """Cria e retorna uma conexão com o banco de dados."""
+    try:
+        connection = pymysql.connect(
+            host=DB_HOST,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            database=DB_NAME,
+            port=DB_PORT,
+            charset='utf8mb4',
+            cursorclass=pymysql.cursors.DictCursor
+        )
+        return connection
+    except pymysql.MySQLError as e:
+        print(f"Erro ao conectar ao MySQL: {e}")
+        return None
+
+
+def proximo_mes(data):
+    return (data.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def garantir_particoes(connection, ate):
+    """Cria as partições mensais que faltam até o mês de `ate`, dividindo pmax. Retorna os nomes criados.
+
+    Só é possível acrescentar meses depois da última partição existente; meses anteriores à primeira
+    caem nela. DDL faz commit implícito, por isso roda antes de mover qualquer caso.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT PARTITION_NAME FROM INFORMATION_SCHEMA.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'USERINPUT_ARQUIVO' AND PARTITION_NAME <> 'pmax'
+            ORDER BY PARTITION_ORDINAL_POSITION
+        """)
+        existentes = [row['PARTITION_NAME'] for row in cursor.fetchall()]
+        if not existentes:
+            raise RuntimeError("USERINPUT_ARQUIVO não existe ou não está particionada (ver documentation_app.txt).")
+
+        ultima = datetime.strptime(existentes[-1], 'p%Y%m')
+        novas, mes = [], proximo_mes(ultima)
+        while mes <= ate:
+            novas.append(f"PARTITION p{mes:%Y%m} VALUES LESS THAN (UNIX_TIMESTAMP('{proximo_mes(mes):%Y-%m-%d} 00:00:00'))")
+            mes = proximo_mes(mes)
+        if novas:
+            cursor.execute(f"""
+                ALTER TABLE USERINPUT_ARQUIVO REORGANIZE PARTITION pmax INTO (
+                    {', '.join(novas)},
+                    PARTITION pmax VALUES LESS THAN MAXVALUE
+                )
+            """)
+        return [p.split()[1] for p in novas]
+
+
+def arquivar_resolvidos(connection, dias):
+    """Move em lotes os casos resolvidos antes de agora - `dias` (e suas mensagens). Retorna (casos, mensagens)."""
+    limite = datetime.now() - timedelta(days=dias)
+    total_casos = total_mensagens = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT ID FROM USERINPUT
+                WHERE RESOLVIDO = 1 AND RESOLVIDO_AT < %s
+                ORDER BY ID LIMIT %s FOR UPDATE
+            """, (limite, LOTE))
+            ids = [row['ID'] for row in cursor.fetchall()]
+            if not ids:
+                break
+            marcadores = ', '.join(['%s'] * len(ids))
+            cursor.execute(f"INSERT INTO USERINPUT_ARQUIVO ({COLUNAS_CASO}) "
+                           f"SELECT {COLUNAS_CASO} FROM USERINPUT WHERE ID IN ({marcadores})", ids)
+            total_mensagens += cursor.execute(f"INSERT INTO MESSAGES_ARQUIVO ({COLUNAS_MENSAGEM}) "
+                                              f"SELECT {COLUNAS_MENSAGEM} FROM MESSAGES WHERE PetID IN ({marcadores})", ids)
+            cursor.execute(f"DELETE FROM MESSAGES WHERE PetID IN ({marcadores})", ids)
+            total_casos += cursor.execute(f"DELETE FROM USERINPUT WHERE ID IN ({marcadores})", ids)
+        connection.commit()
+        print(f"  {total_casos} casos arquivados até agora...")
+    return total_casos, total_mensagens
+
+
+if __name__ == "__main__":
+    dias = int(sys.argv[1]) if len(sys.argv) > 1 else ARQUIVAR_APOS_DIAS
+    conn = create_db_connection()
+    if conn:
+        try:
+            criadas = garantir_particoes(conn, datetime.now() - timedelta(days=dias))
+            if criadas:
+                print(f"Partições criadas: {', '.join(criadas)}")
+            casos, mensagens = arquivar_resolvidos(conn, dias)
+            print(f"Arquivamento concluído: {casos} casos e {mensagens} mensagens resolvidos há mais de {dias} dias.")
+        except (pymysql.MySQLError, RuntimeError) as e:
+            print(f"Erro ao arquivar casos resolvidos: {e}")
+            conn.rollback()
+        finally:
+            conn.close()
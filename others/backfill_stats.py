@@ -0,0 +1,131 @@
+import os
+import sys
+import pymysql
+from dotenv import load_dotenv
+
+# Reaproveita as faixas do histograma e a tokenização dos comentários definidas no app,
+# para que o backfill e a atualização incremental usem exatamente as mesmas regras.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from app import faixa_tempo_resolucao, tokenizar_comentario
+
+# Carregar variáveis de ambiente do arquivo .env
+load_dotenv()
+
+DB_HOST = os.getenv('MYSQL_HOST')
+DB_USER = os.getenv('MYSQL_USER')
+DB_PASSWORD = os.getenv('MYSQL_PASSWORD')
+DB_NAME = os.getenv('MYSQL_DB')
+DB_PORT = int(os.getenv('MYSQL_PORT', 3306))
+
+
+def create_db_connection():
+    """Cria e retorna uma conexão com o banco de dados."""
+    try:
+        connection = pymysql.connect(
+            host=DB_HOST,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            database=DB_NAME,
+            port=DB_PORT,
+            charset='utf8mb4',
+            cursorclass=pymysql.cursors.DictCursor
+        )
+        return connection
+    except pymysql.MySQLError as e:
+        print(f"Erro ao conectar ao MySQL: {e}")
+        return None
+
+
+def fonte_casos(cursor):
+    """USERINPUT mais o arquivo de casos resolvidos (se a tabela já existir), como tabela derivada."""
+    cursor.execute("SHOW TABLES LIKE 'USERINPUT_ARQUIVO'")
+    if not cursor.fetchone():
+        return "USERINPUT"
+    colunas = "CIDADE, BAIRRO, ESPECIE, CREATED_AT, RESOLVIDO, RESOLVIDO_AT"
+    return f"(SELECT {colunas} FROM USERINPUT UNION ALL SELECT {colunas} FROM USERINPUT_ARQUIVO) AS casos"
+
+
+def rebuild_rollups(connection):
+    """Recalcula STATS_DIARIAS e STATS_TEMPO_RESOLUCAO a partir dos casos (ativos e arquivados) em uma única transação."""
+    with connection.cursor() as cursor:
+        casos = fonte_casos(cursor)
+
+        # DELETE (e não TRUNCATE) para que tudo fique na mesma transação
+        cursor.execute("DELETE FROM STATS_TEMPO_RESOLUCAO")
+        cursor.execute("DELETE FROM STATS_DIARIAS")
+
+        cursor.execute(f"""
+            INSERT INTO STATS_DIARIAS (CIDADE, DIA, BAIRRO, ESPECIE, NOVOS_CASOS, RESOLUCOES)
+            SELECT CIDADE, DATE(CREATED_AT), BAIRRO, ESPECIE, COUNT(*), 0
+            FROM {casos}
+            GROUP BY CIDADE, DATE(CREATED_AT), BAIRRO, ESPECIE
+        """)
+        cursor.execute(f"""
+            INSERT INTO STATS_DIARIAS (CIDADE, DIA, BAIRRO, ESPECIE, NOVOS_CASOS, RESOLUCOES)
+            SELECT * FROM (
+                SELECT CIDADE, DATE(RESOLVIDO_AT) AS DIA, BAIRRO, ESPECIE, 0 AS NOVOS, COUNT(*) AS QTD
+                FROM {casos}
+                WHERE RESOLVIDO = 1 AND RESOLVIDO_AT IS NOT NULL
+                GROUP BY CIDADE, DATE(RESOLVIDO_AT), BAIRRO, ESPECIE
+            ) AS resolvidos
+            ON DUPLICATE KEY UPDATE RESOLUCOES = VALUES(RESOLUCOES)
+        """)
+
+        # O histograma é montado em Python para usar a mesma função de faixas do app
+        cursor.execute(f"""
+            SELECT CIDADE, DATE(RESOLVIDO_AT) AS DIA, BAIRRO, ESPECIE,
+                   TIMESTAMPDIFF(SECOND, CREATED_AT, RESOLVIDO_AT) AS SEGUNDOS
+            FROM {casos}
+            WHERE RESOLVIDO = 1 AND RESOLVIDO_AT IS NOT NULL
+        """)
+        histograma = {}
+        for row in cursor.fetchall():
+            chave = (row['CIDADE'], row['DIA'], row['BAIRRO'], row['ESPECIE'], faixa_tempo_resolucao((row['SEGUNDOS'] or 0) / 3600))
+            histograma[chave] = histograma.get(chave, 0) + 1
+
+        if histograma:
+            cursor.executemany("""
+                INSERT INTO STATS_TEMPO_RESOLUCAO (CIDADE, DIA, BAIRRO, ESPECIE, FAIXA, QTD)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, [chave + (qtd,) for chave, qtd in histograma.items()])
+
+    connection.commit()
+    return len(histograma)
+
+
+def rebuild_termos(connection):
+    """Recalcula TERMOS_COMENTARIOS a partir dos comentários dos casos abertos. Retorna o número de termos."""
+    contagem = {}
+    # Cursor do servidor: os comentários são lidos em streaming, só a contagem fica em memória
+    with connection.cursor(pymysql.cursors.SSDictCursor) as cursor:
+        cursor.execute("""
+            SELECT CIDADE, COMENTARIO FROM USERINPUT
+            WHERE (RESOLVIDO = 0 OR RESOLVIDO IS NULL) AND COMENTARIO IS NOT NULL
+        """)
+        for row in cursor:
+            for termo in tokenizar_comentario(row['COMENTARIO']):
+                chave = (row['CIDADE'], termo)
+                contagem[chave] = contagem.get(chave, 0) + 1
+
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM TERMOS_COMENTARIOS")
+        if contagem:
+            cursor.executemany("INSERT INTO TERMOS_COMENTARIOS (CIDADE, TERMO, QTD) VALUES (%s, %s, %s)",
+                               [chave + (qtd,) for chave, qtd in contagem.items()])
+    connection.commit()
+    return len(contagem)
+
+
+if __name__ == "__main__":
+    conn = create_db_connection()
+    if conn:
+        try:
+            faixas_inseridas = rebuild_rollups(conn)
+            print(f"Rollups reconstruídos. Linhas de histograma inseridas: {faixas_inseridas}")
+            termos_inseridos = rebuild_termos(conn)
+            print(f"Índice de termos dos comentários reconstruído. Termos distintos: {termos_inseridos}")
+        except pymysql.MySQLError as e:
+            print(f"Erro ao reconstruir rollups: {e}")
+            conn.rollback()
+        finally:
+            conn.close()
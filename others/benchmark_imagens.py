@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import subprocess
+import tempfile
+from io import BytesIO
+from PIL import Image
+
+# Mede latência e pico de memória (VmHWM) da geração do thumbnail para fotos de celular de 2 a 48 MP.
+# Cada medição roda em um processo novo, para que o pico de uma não contamine a outra. Modos:
+#   antigo   -> como era antes: foto salva em disco, Image.open + thumbnail
+#   completo -> decodificação em resolução total + orientação EXIF + thumbnail
+#   novo     -> create_thumbnail do app (draft JPEG, limite de pixels, EXIF, direto do stream)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+MEGAPIXELS = [2, 12, 24, 48]
+MODOS = ['antigo', 'completo', 'novo']
+PROPORCAO = (4, 3)
+
+
+def memoria_kb(campo):
+    with open('/proc/self/status') as f:
+        for linha in f:
+            if linha.startswith(campo):
+                return int(linha.split()[1])
+    return 0
+
+
+def gerar_foto(megapixels, caminho):
+    altura = int((megapixels * 1_000_000 * PROPORCAO[1] / PROPORCAO[0]) ** 0.5)
+    largura = altura * PROPORCAO[0] // PROPORCAO[1]
+    ruido = Image.effect_noise((largura, altura), 40)
+    foto = Image.merge('RGB', (ruido, ruido.transpose(Image.Transpose.FLIP_LEFT_RIGHT), ruido.transpose(Image.Transpose.FLIP_TOP_BOTTOM)))
+    exif = Image.Exif()
+    exif[0x0112] = 6 # Orientação "girar 90°", comum em fotos de celular na vertical
+    foto.save(caminho, format='JPEG', quality=90, exif=exif)
+
+
+def medir(modo, caminho):
+    """Roda dentro do processo filho: imprime 'segundos pico_kb'."""
+    from PIL import ImageOps
+    from app import create_thumbnail, THUMBNAIL_SIZE
+    with open(caminho, 'rb') as f:
+        conteudo = BytesIO(f.read()) # Simula o stream do upload já recebido
+    antes = memoria_kb('VmRSS')
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5') # Zera o VmHWM para medir só o pico desta etapa
+    inicio = time.perf_counter()
+    if modo == 'antigo':
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as original, tempfile.NamedTemporaryFile(suffix='.jpg') as thumb:
+            original.write(conteudo.getvalue())
+            original.flush()
+            with Image.open(original.name) as img:
+                img.thumbnail(THUMBNAIL_SIZE)
+                img.save(thumb.name)
+    elif modo == 'completo':
+        with Image.open(conteudo) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail(THUMBNAIL_SIZE)
+            img.save(BytesIO(), format='JPEG')
+    else:
+        assert create_thumbnail(conteudo)
+    segundos = time.perf_counter() - inicio
+    print(f"{segundos} {memoria_kb('VmHWM') - antes}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        medir(sys.argv[1], sys.argv[2])
+        sys.exit(0)
+
+    print(f"{'MP':>3} | {'arquivo (MB)':>12} | " + " | ".join(f"{m + ' (ms)':>13} | {m + ' (MB)':>13}" for m in MODOS))
+    with tempfile.TemporaryDirectory() as diretorio:
+        for megapixels in MEGAPIXELS:
+            caminho = os.path.join(diretorio, f"foto_{megapixels}mp.jpg")
+            gerar_foto(megapixels, caminho)
+            colunas = []
+            for modo in MODOS:
+                saida = subprocess.run([sys.executable, os.path.abspath(__file__), modo, caminho],
+                                       capture_output=True, text=True, check=True).stdout.split()
+                colunas.append(f"{float(saida[0]) * 1000:>13.0f} | {int(saida[1]) / 1024:>13.1f}")
+            print(f"{megapixels:>3} | {os.path.getsize(caminho) / 1024 / 1024:>12.1f} | " + " | ".join(colunas))
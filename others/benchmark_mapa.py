@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import random
+
+# Compara o renderizador do mapa baseado em folium (objetos por marcador) com o
+# renderizador leve (template Leaflet + JSON) para 100, 1k e 10k marcadores.
+# Não acessa banco nem S3: os pets são sintéticos e o sprite atlas é simulado.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from app import app, renderizar_mapa_folium, renderizar_mapa_leve, SPRITE_CELL_SIZE, SPRITE_COLUMNS
+
+TAMANHOS = [100, 1000, 10000]
+REPETICOES = 3
+CENTRO = [-22.7532, -47.3330]
+
+
+def gerar_pets(quantidade):
+    random.seed(quantidade)
+    return [{
+        'ID': i,
+        'NOME_PET': f"Pet {i}",
+        'ESPECIE': random.choice(['Cachorro', 'Gato', 'Pássaro']),
+        'BAIRRO': 'Centro',
+        'STATUS_PET': random.choice(['Perdi meu PET', 'Encontrei um PET']),
+        'THUMBNAIL_PATH': f"uploads/thumbnails_pet/thumb_{i}.jpg",
+        'LATITUDE': CENTRO[0] + random.uniform(-0.05, 0.05),
+        'LONGITUDE': CENTRO[1] + random.uniform(-0.05, 0.05),
+    } for i in range(1, quantidade + 1)]
+
+
+def gerar_manifesto(pets):
+    linhas = -(-len(pets) // SPRITE_COLUMNS)
+    return {
+        'atlas_key': 'uploads/sprites/atlas_benchmark.webp',
+        'celula': SPRITE_CELL_SIZE,
+        'colunas': SPRITE_COLUMNS,
+        'largura': SPRITE_COLUMNS * SPRITE_CELL_SIZE,
+        'altura': linhas * SPRITE_CELL_SIZE,
+        'slots': {str(p['ID']): indice for indice, p in enumerate(pets)},
+    }
+
+
+def medir(renderizador, pets, manifesto):
+    tempos = []
+    for _ in range(REPETICOES):
+        inicio = time.perf_counter()
+        html = renderizador(pets, CENTRO, 13, manifesto)
+        tempos.append(time.perf_counter() - inicio)
+    return min(tempos), len(html.encode('utf-8'))
+
+
+if __name__ == "__main__":
+    print(f"{'marcadores':>10} | {'folium (s)':>10} | {'leve (s)':>9} | {'folium (KB)':>11} | {'leve (KB)':>9}")
+    with app.test_request_context('/'):
+        for quantidade in TAMANHOS:
+            pets = gerar_pets(quantidade)
+            manifesto = gerar_manifesto(pets)
+            tempo_folium, tamanho_folium = medir(renderizar_mapa_folium, pets, manifesto)
+            tempo_leve, tamanho_leve = medir(renderizar_mapa_leve, pets, manifesto)
+            print(f"{quantidade:>10} | {tempo_folium:>10.3f} | {tempo_leve:>9.3f} | "
+                  f"{tamanho_folium / 1024:>11.0f} | {tamanho_leve / 1024:>9.0f}")
@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+import http.client
+
+# Mede a vazão (requisições/s) do app no gunicorn com 1, 2, 4... workers, com a mesma configuração
+# de produção (gunicorn.conf.py: workers sync, preload_app, caches aquecidos no master).
+# Não acessa banco nem S3: usa as versões falsas de contagem_conexoes.py, com uma latência
+# simulada por comando SQL, para que o teste tenha a mistura de espera de I/O e CPU (templates,
+# folium, matplotlib no dashboard) de uma requisição real.
+# Uso: python benchmark_workers.py [workers separados por vírgula]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LATENCIA_DB = float(os.getenv('LATENCIA_DB', '0.005')) # segundos por ida ao banco
+WORKERS = [1, 2, 4, 8]
+CLIENTES = 16   # conexões simultâneas do gerador de carga
+DURACAO = 10    # segundos de medição por configuração
+ROTAS = ['/', '/pet/1', '/dashboard', '/api/stats/termos']
+
+
+def montar_app():
+    """Fábrica usada pelo gunicorn (benchmark_workers:montar_app()): app com banco e S3 falsos."""
+    import contagem_conexoes as falsos
+    buscapet = falsos.buscapet
+
+    class CursorLento(falsos.CursorFalso):
+        def execute(self, sql, params=None):
+            time.sleep(LATENCIA_DB)
+            return super().execute(sql, params)
+
+    class ConexaoLenta(falsos.ConexaoFalsa):
+        def cursor(self, cls=None):
+            return CursorLento()
+
+    buscapet.pymysql.connect = lambda **kwargs: ConexaoLenta()
+    buscapet.S3_BUCKET = 'bucket-falso'
+    buscapet.init_s3 = lambda: None # Os workers mantêm o S3 falso depois do fork
+    buscapet.s3_client = falsos.S3Falso()
+    return buscapet.create_app({'AQUECER_CACHES': True})
+
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def aguardar_servidor(porta, limite=60):
+    fim = time.monotonic() + limite
+    while time.monotonic() < fim:
+        try:
+            with socket.create_connection(('127.0.0.1', porta), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn não respondeu a tempo.")
+
+
+def gerar_carga(porta, duracao):
+    """Dispara CLIENTES threads em loop pelas ROTAS durante `duracao`. Retorna (respostas, erros)."""
+    resultados = {'ok': 0, 'erros': 0}
+    trava = threading.Lock()
+    fim = time.monotonic() + duracao
+
+    def cliente(indice):
+        ok = erros = 0
+        conexao = http.client.HTTPConnection('127.0.0.1', porta, timeout=30)
+        i = indice
+        while time.monotonic() < fim:
+            try:
+                conexao.request('GET', ROTAS[i % len(ROTAS)])
+                resposta = conexao.getresponse()
+                resposta.read()
+                if resposta.status == 200:
+                    ok += 1
+                else:
+                    erros += 1
+                if resposta.getheader('Connection', '').lower() == 'close':
+                    conexao.close() # Workers sync fecham a conexão a cada resposta
+            except (OSError, http.client.HTTPException):
+                erros += 1
+                conexao.close()
+            i += 1
+        conexao.close()
+        with trava:
+            resultados['ok'] += ok
+            resultados['erros'] += erros
+
+    threads = [threading.Thread(target=cliente, args=(n,)) for n in range(CLIENTES)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return resultados['ok'], resultados['erros']
+
+
+def medir(workers):
+    porta = porta_livre()
+    processo = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(RAIZ, 'gunicorn.conf.py'),
+         '--chdir', os.path.dirname(os.path.abspath(__file__)), '--bind', f"127.0.0.1:{porta}",
+         '--workers', str(workers), '--access-logfile', '/dev/null', '--log-level', 'warning',
+         'benchmark_workers:montar_app()'],
+        env=dict(os.environ, SECRET_KEY=os.getenv('SECRET_KEY', 'benchmark-workers')), # Exigida pelo gunicorn.conf.py
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        aguardar_servidor(porta)
+        gerar_carga(porta, 2) # Aquecimento: primeiras requisições de cada worker (templates, fontes)
+        ok, erros = gerar_carga(porta, DURACAO)
+    finally:
+        processo.terminate()
+        processo.wait()
+    return ok / DURACAO, erros
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        WORKERS = [int(n) for n in sys.argv[1].split(',')]
+    print(f"Núcleos: {os.cpu_count()} | latência simulada do banco: {LATENCIA_DB * 1000:.0f} ms/comando | "
+          f"{CLIENTES} clientes | rotas: {', '.join(ROTAS)}")
+    print(f"{'workers':>7} | {'req/s':>8} | {'erros':>5}")
+    for workers in WORKERS:
+        vazao, erros = medir(workers)
+        print(f"{workers:>7} | {vazao:>8.1f} | {erros:>5}")
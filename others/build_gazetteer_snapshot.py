@@ -0,0 +1,96 @@
+import os
+import sys
+import csv
+import time
+import pymysql
+from dotenv import load_dotenv
+
+# Compila a tabela LOCATIONS no snapshot binário lido via mmap pelo app (api/data/gazetteer.bin).
+# Uso:
+#   python build_gazetteer_snapshot.py                 -> lê LOCATIONS do MySQL (.env)
+#   python build_gazetteer_snapshot.py --csv output.csv -> lê o CSV usado pelo migration.py
+# O app compara o nº de linhas e o maior ID gravados no snapshot com LOCATIONS (no aquecimento dos
+# caches e quando uma busca não encontra o bairro/rua no snapshot, no máximo uma vez por hora por
+# processo) e volta ao banco se não baterem: rode de novo depois de alterar LOCATIONS. Gerado do
+# CSV, só o nº de linhas é conferido. Edições de linhas existentes (UPDATE) não mudam o marcador.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from app import escrever_snapshot_gazetteer, GazetteerSnapshot, GAZETTEER_SNAPSHOT_PATH
+
+load_dotenv()
+
+DB_HOST = os.getenv('MYSQL_HOST')
+DB_USER = os.getenv('MYSQL_USER')
+DB_PASSWORD = os.getenv('MYSQL_PASSWORD')
+DB_NAME = os.getenv('MYSQL_DB')
+DB_PORT = int(os.getenv('MYSQL_PORT', 3306))
+
+
+def create_db_connection():
+    """Cria e retorna uma conexão com o banco de dados."""
+    try:
+        connection = pymysql.connect(
+            host=DB_HOST,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            database=DB_NAME,
+            port=DB_PORT,
+            charset='utf8mb4',
+            cursorclass=pymysql.cursors.SSCursor # Lê as linhas em streaming
+        )
+        return connection
+    except pymysql.MySQLError as e:
+        print(f"Erro ao conectar ao MySQL: {e}")
+        return None
+
+
+def maior_id(connection):
+    # Mesma transação da leitura seguinte (REPEATABLE READ): o marcador corresponde às linhas lidas
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT COALESCE(MAX(ID), 0) FROM LOCATIONS")
+        return cursor.fetchone()[0]
+
+
+def localizacoes_do_banco(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT CIDADE, BAIRRO, RUA, LATITUDE, LONGITUDE FROM LOCATIONS ORDER BY ID")
+        for cidade, bairro, rua, lat, lon in cursor:
+            yield cidade, bairro, rua, float(lat), float(lon)
+
+
+def localizacoes_do_csv(csv_path):
+    # Mesmas regras do migration.py: UTF-8 com fallback para latin1, campos sem espaços nas pontas
+    try:
+        with open(csv_path, encoding='utf-8') as f:
+            linhas = list(csv.DictReader(f, delimiter=';'))
+    except UnicodeDecodeError:
+        print("Falha ao decodificar como UTF-8. Tentando com 'latin1'...")
+        with open(csv_path, encoding='latin1') as f:
+            linhas = list(csv.DictReader(f, delimiter=';'))
+    for row in linhas:
+        row = {k.strip().upper(): (v or '').strip() for k, v in row.items()}
+        try:
+            lat = float(row['LATITUDE'].replace(',', '.'))
+            lon = float(row['LONGITUDE'].replace(',', '.'))
+        except ValueError:
+            continue
+        if row['RUA'] and row['BAIRRO'] and row['CIDADE']:
+            yield row['CIDADE'], row['BAIRRO'], row['RUA'], lat, lon
+
+
+if __name__ == "__main__":
+    inicio = time.perf_counter()
+    if len(sys.argv) > 2 and sys.argv[1] == '--csv':
+        cidades, bairros, ruas = escrever_snapshot_gazetteer(localizacoes_do_csv(sys.argv[2]), GAZETTEER_SNAPSHOT_PATH)
+    else:
+        conn = create_db_connection()
+        if not conn:
+            sys.exit(1)
+        try:
+            max_id = maior_id(conn)
+            cidades, bairros, ruas = escrever_snapshot_gazetteer(localizacoes_do_banco(conn), GAZETTEER_SNAPSHOT_PATH, max_id)
+        finally:
+            conn.close()
+
+    snapshot = GazetteerSnapshot(GAZETTEER_SNAPSHOT_PATH) # Valida o arquivo gerado
+    print(f"Snapshot gerado em {GAZETTEER_SNAPSHOT_PATH} ({os.path.getsize(GAZETTEER_SNAPSHOT_PATH) / 1024:.0f} KB, "
+          f"{time.perf_counter() - inicio:.2f}s): {cidades} cidades, {bairros} bairros, {ruas} ruas")
@@ -0,0 +1,168 @@
+import os
+import sys
+import uuid
+from io import BytesIO
+from datetime import datetime
+from PIL import Image
+from botocore.exceptions import ClientError
+
+# Conta quantas conexões MySQL e quantas idas ao banco (execute) cada rota faz por requisição.
+# Não acessa banco nem S3: pymysql.connect e o cliente S3 são trocados por versões falsas que
+# apenas registram as chamadas e devolvem linhas plausíveis. Confere a unidade de trabalho por
+# requisição: termina com código 1 se alguma rota abrir mais de uma conexão, passar do número
+# de comandos esperado (última coluna de ROTAS) ou responder com outro status.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+import app as buscapet
+
+PET = {'ID': 1, 'NOME_PET': 'Bob', 'ESPECIE': 'Cachorro', 'RUA': 'Rua A', 'BAIRRO': 'Centro',
+       'CIDADE': 'Americana/SP', 'CONTATO': '(19) 99999-9999', 'COMENTARIO': 'Coleira azul',
+       'FOTO_PATH': 'uploads/imagens_pet/x.jpg', 'THUMBNAIL_PATH': 'uploads/thumbnails_pet/thumb_x.jpg',
+       'CREATED_AT': datetime(2025, 1, 1, 12, 0), 'STATUS_PET': 'Perdi meu PET', 'RESOLVIDO': 0,
+       'RESOLVIDO_AT': None, 'LATITUDE': -22.75, 'LONGITUDE': -47.33}
+
+contagem = {'conexoes': 0, 'comandos': 0}
+
+
+class CursorFalso:
+    def __init__(self):
+        self.sql = ''
+        self.lastrowid = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        contagem['comandos'] += 1
+        self.sql = ' '.join(sql.split()).upper()
+        return 1
+
+    def executemany(self, sql, linhas):
+        return self.execute(sql) # O pymysql envia um único INSERT multi-valores
+
+    def fetchone(self):
+        if 'GET_LOCK' in self.sql:
+            return {'TRAVA': 1}
+        if 'COUNT(*)' in self.sql or 'SUM(' in self.sql:
+            return {'total': 1, 'max_id': 1}
+        if 'FROM LOCATIONS' in self.sql:
+            return {'LATITUDE': -22.75, 'LONGITUDE': -47.33}
+        return dict(PET)
+
+    def fetchall(self):
+        if 'COUNT(*)' in self.sql:
+            return [{'total': 1}]
+        if 'FROM CIDADES' in self.sql or 'FROM STATS_' in self.sql:
+            return []
+        if 'FROM TERMOS_COMENTARIOS' in self.sql:
+            return [{'TERMO': 'coleira', 'QTD': 2}, {'TERMO': 'azul', 'QTD': 1}]
+        if 'FROM MESSAGES' in self.sql:
+            return [{'MessageID': 1, 'CommenterName': 'Ana', 'MessageText': 'Vi na praça', 'CreatedAt': datetime.now()}]
+        if 'GROUP BY BAIRRO' in self.sql:
+            return [{'BAIRRO': 'Centro', 'count': 1}]
+        if 'SELECT DISTINCT BAIRRO' in self.sql:
+            return [{'BAIRRO': 'Centro'}]
+        return [dict(PET)]
+
+    def close(self):
+        pass
+
+
+class ConexaoFalsa:
+    open = True
+
+    def cursor(self):
+        return CursorFalso()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.open = False
+
+
+class S3Falso:
+    def upload_file(self, *args, **kwargs):
+        pass
+
+    def upload_fileobj(self, *args, **kwargs):
+        pass
+
+    def put_object(self, **kwargs):
+        pass
+
+    def delete_object(self, **kwargs):
+        pass
+
+    def get_object(self, **kwargs):
+        raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+
+def conectar_falso(**kwargs):
+    contagem['conexoes'] += 1
+    return ConexaoFalsa()
+
+
+def foto_png():
+    buffer = BytesIO()
+    Image.new('RGB', (64, 64), (200, 120, 40)).save(buffer, format='PNG')
+    buffer.seek(0)
+    return buffer
+
+
+MAX_CONEXOES = 1
+
+# (nome, método, url, argumentos, status esperado, máximo de comandos SQL)
+ROTAS = [
+    ('GET /', 'get', '/', {}, 200, 1),
+    ('GET /pet/1', 'get', '/pet/1', {}, 200, 2),
+    ('GET /cadastrar-pet', 'get', '/cadastrar-pet', {}, 200, 0),
+    ('POST /cadastrar-pet', 'post', '/cadastrar-pet', lambda: {
+        'data': {'nome_pet': 'Bob', 'especie': 'Cachorro', 'bairro': 'Bairro Inexistente', 'rua': 'Rua A',
+                 'cidade': 'Americana/SP', 'contato': '(19) 99999-9999', 'comentario': 'Coleira azul',
+                 'status_pet': 'Perdi meu PET', 'foto_pet': (foto_png(), 'bob.png')},
+        'content_type': 'multipart/form-data'}, 302, 10), # +2: GET_LOCK/RELEASE_LOCK da trava do atlas; +4: SAVEPOINTs dos rollups e dos termos
+    ('POST /pet/1/add_message', 'post', '/pet/1/add_message', lambda: {
+        'data': {'commenter_name': 'Ana', 'message_text': 'Vi na praça'}}, 302, 1),
+    ('POST /encerrar_busca/1', 'post', '/encerrar_busca/1', {}, 200, 12), # +4: SAVEPOINTs dos rollups e dos termos
+    ('POST /confirmar_encerrar_busca/1', 'post', '/confirmar_encerrar_busca/1', {}, 302, 12),
+    ('GET /dashboard', 'get', '/dashboard', {}, 200, 5),
+    ('GET /api/stats/timeseries', 'get', '/api/stats/timeseries', {}, 200, 2),
+    ('GET /api/stats/termos', 'get', '/api/stats/termos', {}, 200, 1),
+]
+
+
+if __name__ == "__main__":
+    buscapet.pymysql.connect = conectar_falso
+    buscapet.s3_client = S3Falso()
+    buscapet.S3_BUCKET = 'bucket-falso'
+    # Aquece cidades, bairros e a verificação do gazetteer fora das medições (como num worker já em uso)
+    buscapet.aquecer_caches()
+    cliente = buscapet.app.test_client()
+
+    print(f"{'rota':<34} | {'status':>6} | {'conexões':>8} | {'comandos':>8}")
+    falhas = []
+    for indice, (nome, metodo, url, argumentos, status_esperado, max_comandos) in enumerate(ROTAS):
+        argumentos = argumentos() if callable(argumentos) else dict(argumentos)
+        # Chave de idempotência nova e um "cliente" por rota, para não esbarrar no limite de taxa
+        argumentos['headers'] = {'Idempotency-Key': uuid.uuid4().hex}
+        argumentos['environ_base'] = {'REMOTE_ADDR': f"10.0.0.{indice + 1}"}
+        contagem.update(conexoes=0, comandos=0)
+        resposta = getattr(cliente, metodo)(url, **argumentos)
+        print(f"{nome:<34} | {resposta.status_code:>6} | {contagem['conexoes']:>8} | {contagem['comandos']:>8}")
+        if resposta.status_code != status_esperado:
+            falhas.append(f"{nome}: status {resposta.status_code}, esperado {status_esperado}")
+        if contagem['conexoes'] > MAX_CONEXOES:
+            falhas.append(f"{nome}: {contagem['conexoes']} conexões (máximo {MAX_CONEXOES})")
+        if contagem['comandos'] > max_comandos:
+            falhas.append(f"{nome}: {contagem['comandos']} comandos (máximo {max_comandos})")
+
+    if falhas:
+        print("\nFALHOU:\n  " + "\n  ".join(falhas))
+        sys.exit(1)
+    print("\nOK: nenhuma rota passou do limite de conexões e comandos.")
@@ -0,0 +1,24 @@
+import os
+import sys
+
+# Reconstrói do zero o sprite atlas dos marcadores do mapa (thumbnails de todos os casos
+# abertos), usando as mesmas funções e configurações (.env) do app.
+# Uso: python rebuild_sprite_atlas.py [slug-da-cidade]  (sem argumento: todas as cidades)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from app import reconstruir_atlas_sprites, carregar_manifesto_sprites, carregar_cidades, obter_cidade
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        cidade = obter_cidade(sys.argv[1])
+        if not cidade:
+            sys.exit(f"Cidade não encontrada: {sys.argv[1]}")
+        cidades = [cidade]
+    else:
+        cidades = list(carregar_cidades().values())
+
+    for cidade in cidades:
+        if reconstruir_atlas_sprites(cidade['nome']):
+            manifesto = carregar_manifesto_sprites(cidade['nome'])
+            print(f"{cidade['nome']}: sprite atlas publicado em {manifesto.get('atlas_key')} ({len(manifesto.get('slots', {}))} pets)")
+        else:
+            print(f"{cidade['nome']}: não foi possível reconstruir o sprite atlas. Verifique os logs e as credenciais S3/MySQL.")